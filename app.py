@@ -1,5 +1,8 @@
 import asyncio
 import logging
+
+import httpx
+import orjson
 from starlette.applications import Starlette
 from starlette.requests import Request
 from starlette.responses import JSONResponse
@@ -10,7 +13,8 @@ from config import load_config
 from claude_client import ClaudeClient
 from conversations import ConversationStore
 from transcriber import Transcriber
-from bot import handle_message
+from bot import drain_background, handle_message, is_bot_mentioned, is_reply_to_bot, reset_voice_reminder
+from telegram_api import api_url
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,76 +24,119 @@ claude = ClaudeClient(api_key=config.anthropic_api_key, skill_id=config.rk_skill
 store = ConversationStore(database_url=config.database_url)
 transcriber = Transcriber(soniox_api_key=config.soniox_api_key)
 
-# We need the bot's user ID and username to detect mentions/replies.
-# Fetched once on first webhook via getMe.
-_bot_user_id: int | None = None
-_bot_username: str = ""
+# Shared client so Telegram API calls reuse keep-alive connections instead of
+# paying a TCP+TLS handshake per request.
+http = httpx.AsyncClient(
+    # Uploads can be slow to write; a short pool timeout surfaces saturation
+    # instead of letting handlers queue indefinitely.
+    timeout=httpx.Timeout(connect=5.0, read=15.0, write=15.0, pool=2.0),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+)
+
+# Hold references to in-flight handlers so they can't be garbage-collected
+# mid-await, and cap how many run at once so a flood of updates degrades
+# gracefully instead of exhausting Claude rate limits or sockets.
+MAX_CONCURRENT_HANDLERS = 64
+_tasks: set[asyncio.Task] = set()
+_slots = asyncio.Semaphore(MAX_CONCURRENT_HANDLERS)
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 
 async def health(request: Request) -> JSONResponse:
-    return JSONResponse({"status": "ok"})
+    return ORJSONResponse({"status": "ok"})
 
 
 async def webhook(request: Request) -> JSONResponse:
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
     if secret != config.webhook_secret:
-        return JSONResponse({"error": "forbidden"}, status_code=403)
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
 
-    body = await request.json()
+    body = orjson.loads(await request.body())
     update = Update.de_json(body, bot=None)
 
-    has_content = update and update.message and (update.message.text or update.message.voice)
-    if has_content:
-        global _bot_user_id, _bot_username
-        if _bot_user_id is None:
-            import httpx
-            async with httpx.AsyncClient() as http:
-                resp = await http.get(
-                    f"https://api.telegram.org/bot{config.telegram_bot_token}/getMe"
-                )
-                me = resp.json()["result"]
-                _bot_user_id = me["id"]
-                _bot_username = me.get("username", "")
-                logger.info("Bot info fetched: id=%s username=%s", _bot_user_id, _bot_username)
-
-        user = update.message.from_user
+    message = update.message if update else None
+    if not message or not (message.text or message.voice):
+        logger.debug("Webhook received non-text update, ignoring")
+        return ORJSONResponse({"ok": True})
+
+    # Most group chatter isn't for the bot; drop it here instead of spawning a task.
+    # Voice notes always go through so the handler can send its reply reminder.
+    state = request.app.state
+    addressed = (
+        message.voice
+        or is_reply_to_bot(message, state.bot_user_id)
+        or is_bot_mentioned(message, state.bot_user_id, state.bot_mention)
+    )
+    if addressed:
+        user = message.from_user
         user_name = f"{user.first_name} ({user.id})" if user else "unknown"
-        msg_preview = (update.message.text or "[voice]")[:80]
+        msg_preview = (message.text or "[voice]")[:80]
         logger.info("Webhook received: chat=%s user=%s text=%r",
-                     update.message.chat.id, user_name, msg_preview)
+                     message.chat.id, user_name, msg_preview)
 
         async def _safe_handle():
             try:
-                await handle_message(
-                    message=update.message,
-                    bot_user_id=_bot_user_id,
-                    bot_username=_bot_username,
-                    claude=claude,
-                    store=store,
-                    transcriber=transcriber,
-                    telegram_token=config.telegram_bot_token,
-                )
+                async with _slots:
+                    await handle_message(
+                        message=message,
+                        bot_user_id=state.bot_user_id,
+                        bot_mention=state.bot_mention,
+                        claude=claude,
+                        store=store,
+                        transcriber=transcriber,
+                        telegram_token=config.telegram_bot_token,
+                        http=http,
+                    )
             except Exception:
                 logger.exception("Unhandled error in handle_message for chat=%s",
-                                 update.message.chat.id)
+                                 message.chat.id)
 
-        asyncio.create_task(_safe_handle())
+        task = asyncio.create_task(_safe_handle())
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
     else:
-        logger.debug("Webhook received non-text update, ignoring")
+        # Still counts as chatter for the voice reminder, which non-voice
+        # messages reset even when they aren't for the bot
+        reset_voice_reminder(message.chat.id)
+        logger.debug("Webhook received message not addressed to bot, ignoring")
 
     # Always respond 200 quickly so Telegram doesn't retry
-    return JSONResponse({"ok": True})
+    return ORJSONResponse({"ok": True})
 
 
 async def on_startup():
-    store.cleanup()
+    await store.open()
+    await store.cleanup()
+    # We need the bot's user ID and username to detect mentions/replies.
+    resp = await http.get(api_url(config.telegram_bot_token, "getMe"))
+    me = resp.json()["result"]
+    app.state.bot_user_id = me["id"]
+    username = me.get("username", "")
+    # Lowercased "@handle" so per-message mention checks don't redo it
+    app.state.bot_mention = f"@{username.lower()}" if username else ""
+    logger.info("Bot info fetched: id=%s username=%s", app.state.bot_user_id, username)
     logger.info("RK ArtSide bot started")
 
 
+async def on_shutdown():
+    # Let in-flight handlers, then the status deletes they spawned, finish
+    # before closing the client they use
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    await drain_background()
+    await http.aclose()
+    await transcriber.aclose()
+    await store.close()
+
+
 app = Starlette(
     routes=[
         Route("/health", health, methods=["GET"]),
         Route("/webhook", webhook, methods=["POST"]),
     ],
     on_startup=[on_startup],
+    on_shutdown=[on_shutdown],
 )
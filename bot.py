@@ -1,16 +1,39 @@
+import asyncio
+import functools
 import logging
-from datetime import datetime
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, BinaryIO, Callable
 
 import anthropic
 import httpx
+import orjson
 from claude_client import ClaudeClient, ClaudeResponse
 from conversations import ConversationStore, DOC_TYPES
+from telegram_api import api_url
 from transcriber import Transcriber
 
 logger = logging.getLogger(__name__)
 
-# Track chats where we already sent a voice reminder (reset on non-voice messages)
-_voice_reminded: set[int] = set()
+# Telegram accepts 2-10 documents per sendMediaGroup call
+MEDIA_GROUP_MAX = 10
+
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_RETRY_DELAYS = [0.5, 1, 2]  # seconds, unless Telegram sends retry_after
+# Failures where the request provably never reached Telegram, so even a send is safe to retry
+_NEVER_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Fire-and-forget cleanup calls, referenced until done so they aren't
+# garbage-collected mid-flight.
+_background: set[asyncio.Task] = set()
+
+# Chats where we already sent a voice reminder (reset on non-voice messages).
+# Bounded LRU with expiry so it can't grow forever; the reminder comes back
+# after VOICE_REMINDER_TTL seconds.
+VOICE_REMINDER_TTL = 86400
+VOICE_REMINDER_MAX_CHATS = 10_000
+_voice_reminded: OrderedDict[int, float] = OrderedDict()
 
 _DOC_TYPE_KEYWORDS = {
     "COT": ["cotizaci", "cotización"],
@@ -19,77 +42,154 @@ _DOC_TYPE_KEYWORDS = {
     "CARTA": ["carta", "compromiso"],
 }
 
+# One alternation scans the text once, with a named group per document type so
+# a match maps back to its type whatever case folding matched. Longest keywords
+# first so overlapping prefixes ("cotizaci"/"cotización") resolve to one match.
+_DOC_TYPE_RE = re.compile(
+    "|".join(
+        f"(?P<{doc_type}>" + "|".join(re.escape(kw) for kw in sorted(kws, key=len, reverse=True)) + ")"
+        for doc_type, kws in _DOC_TYPE_KEYWORDS.items()
+    ),
+    re.IGNORECASE,
+)
+
 
 def _infer_doc_type(text: str) -> str | None:
-    text_lower = text.lower()
-    for doc_type, keywords in _DOC_TYPE_KEYWORDS.items():
-        if any(kw in text_lower for kw in keywords):
-            return doc_type
-    return None
+    found = {m.lastgroup for m in _DOC_TYPE_RE.finditer(text)}
+    # Keep the declared precedence when several document types are mentioned
+    return next((doc_type for doc_type in _DOC_TYPE_KEYWORDS if doc_type in found), None)
 
 
-def is_bot_mentioned(message, bot_user_id: int, bot_username: str = "") -> bool:
-    if not message.entities:
+_ASSIGNED_NUMBER_CONTEXT = (
+    "\n\n## Numeración de documentos\nUsa exactamente este número para el documento: **{doc_num}**"
+)
+
+
+@functools.lru_cache(maxsize=32)
+def _last_numbers_context(year: int, last_numbers: tuple[tuple[str, str], ...]) -> str:
+    """Render the numbering hint from (doc_type, number) pairs sorted by doc_type.
+
+    Cached because it only changes when a new document is numbered.
+    """
+    if not last_numbers:
+        return f"\n\n## Numeración de documentos\nNo hay documentos generados en {year}. Formato: TIPO-{year}-001 (COT para cotización, PRES para presupuesto, REC para recibo)."
+    lines = [f"\n\n## Numeración de documentos\nÚltimos números generados en {year}:"]
+    for dt, num in last_numbers:
+        label = DOC_TYPES.get(dt, dt)
+        lines.append(f"- {label}: {num}")
+    lines.append("Si necesitas generar un documento, usa el siguiente número consecutivo.")
+    return "\n".join(lines)
+
+
+def _in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def drain_background() -> None:
+    """Wait for fire-and-forget calls still in flight (e.g. before shutdown)."""
+    await asyncio.gather(*_background, return_exceptions=True)
+
+
+def reset_voice_reminder(chat_id: int) -> None:
+    """Forget the chat's voice reminder; any non-voice message resets it."""
+    _voice_reminded.pop(chat_id, None)
+
+
+def _claim_voice_reminder(chat_id: int) -> bool:
+    """Return True if the chat should get the voice reminder now, and record it.
+
+    No awaits inside, so concurrent handlers can't both claim the same chat.
+    """
+    now = time.monotonic()
+    reminded_at = _voice_reminded.get(chat_id)
+    if reminded_at is not None and now - reminded_at < VOICE_REMINDER_TTL:
         return False
-    text = message.text or ""
-    bot_username_lower = bot_username.lower()
-    for e in message.entities:
-        # text_mention: user without username, has e.user
-        if e.type == "text_mention" and e.user and e.user.id == bot_user_id:
-            return True
-        # mention: @username style, no e.user — compare text
-        if e.type == "mention" and bot_username_lower:
-            mention_text = text[e.offset:e.offset + e.length].lower()
-            if mention_text == f"@{bot_username_lower}":
-                return True
+    _voice_reminded[chat_id] = now
+    _voice_reminded.move_to_end(chat_id)
+    while len(_voice_reminded) > VOICE_REMINDER_MAX_CHATS:
+        _voice_reminded.popitem(last=False)
+    return True
+
+
+def _entity_text(encoded: bytes, entity) -> str:
+    # Telegram entity offsets and lengths count UTF-16 code units, so slice the
+    # UTF-16 encoding rather than the str (emoji would shift str indices).
+    return encoded[2 * entity.offset:2 * (entity.offset + entity.length)].decode("utf-16-le")
+
+
+def _is_bot_entity(entity, encoded: bytes, bot_user_id: int, bot_mention: str) -> bool:
+    # text_mention: user without username, has e.user
+    if entity.type == "text_mention" and entity.user and entity.user.id == bot_user_id:
+        return True
+    # mention: @username style, no e.user — compare text (usernames are ASCII, so
+    # a length mismatch rejects other mentions without slicing)
+    if entity.type == "mention" and bot_mention and entity.length == len(bot_mention):
+        return _entity_text(encoded, entity).lower() == bot_mention
     return False
 
 
-def is_reply_to_bot(message, bot_user_id: int) -> bool:
-    if not message.reply_to_message:
+def is_bot_mentioned(message, bot_user_id: int, bot_mention: str = "") -> bool:
+    """bot_mention is the lowercased "@username" handle, computed once at startup."""
+    if not message.entities:
         return False
-    return message.reply_to_message.from_user.id == bot_user_id
+    encoded = (message.text or "").encode("utf-16-le")
+    return any(_is_bot_entity(e, encoded, bot_user_id, bot_mention) for e in message.entities)
 
 
-def extract_user_text(message, bot_user_id: int, bot_username: str = "") -> str:
+def is_reply_to_bot(message, bot_user_id: int) -> bool:
+    reply = message.reply_to_message
+    # Channel and anonymous-admin posts have no from_user
+    return bool(reply and reply.from_user and reply.from_user.id == bot_user_id)
+
+
+def scan_entities(message, bot_user_id: int, bot_mention: str = "") -> tuple[bool, str]:
+    """Return (mentioned, text without the bot mentions) from one pass over the entities."""
     text = message.text or ""
-    bot_username_lower = bot_username.lower()
-    if message.entities:
-        for e in message.entities:
-            is_bot = False
-            if e.type == "text_mention" and e.user and e.user.id == bot_user_id:
-                is_bot = True
-            elif e.type == "mention" and bot_username_lower:
-                mention_text = text[e.offset:e.offset + e.length].lower()
-                is_bot = mention_text == f"@{bot_username_lower}"
-            if is_bot:
-                text = text[:e.offset] + text[e.offset + e.length:]
-    return text.strip()
-
-
-def find_root_message_id(message) -> int:
-    current = message
-    while current.reply_to_message is not None:
-        current = current.reply_to_message
-    return current.message_id
+    if not message.entities:
+        return False, text.strip()
+    encoded = text.encode("utf-16-le")
+    # Collect the kept spans and join once; offsets stay valid because the
+    # original text is never rewritten mid-loop.
+    parts = []
+    cursor = 0
+    mentioned = False
+    for e in sorted(message.entities, key=lambda e: e.offset):
+        if _is_bot_entity(e, encoded, bot_user_id, bot_mention):
+            mentioned = True
+            parts.append(encoded[cursor:2 * e.offset])
+            cursor = 2 * (e.offset + e.length)
+    if not mentioned:
+        return False, text.strip()
+    parts.append(encoded[cursor:])
+    return True, b"".join(parts).decode("utf-16-le").strip()
+
+
+def extract_user_text(message, bot_user_id: int, bot_mention: str = "") -> str:
+    return scan_entities(message, bot_user_id, bot_mention)[1]
 
 
 async def handle_message(
     message,
     bot_user_id: int,
-    bot_username: str,
+    bot_mention: str,
     claude: ClaudeClient,
     store: ConversationStore,
     transcriber: Transcriber,
     telegram_token: str,
+    http: httpx.AsyncClient,
 ):
     is_voice = message.voice is not None
     chat_id = message.chat.id
 
     if not is_voice:
-        _voice_reminded.discard(chat_id)
+        reset_voice_reminder(chat_id)
 
-    mentioned = is_bot_mentioned(message, bot_user_id, bot_username) if not is_voice else False
+    if is_voice:
+        mentioned, user_text = False, None  # transcribed below
+    else:
+        mentioned, user_text = scan_entities(message, bot_user_id, bot_mention)
     replied = is_reply_to_bot(message, bot_user_id)
 
     # Voice messages sent as replies to the bot are always handled
@@ -100,73 +200,62 @@ async def handle_message(
 
     # For voice messages not directed at the bot, send a one-time reminder
     if is_voice and not replied:
-        if chat_id not in _voice_reminded:
-            _voice_reminded.add(chat_id)
-            await _send_text(telegram_token, chat_id, message.message_id,
+        if _claim_voice_reminder(chat_id):
+            await _send_text(http, telegram_token, chat_id, message.message_id,
                              "Para que pueda escuchar tu nota de voz, responde directamente a uno de mis mensajes.")
         return
 
     # Check if the replied-to message has content we should include
     reply_has_voice = (not is_voice and message.reply_to_message
-                       and hasattr(message.reply_to_message, 'voice')
                        and message.reply_to_message.voice is not None)
     reply_has_text = (not is_voice and mentioned and message.reply_to_message
                       and not replied
-                      and getattr(message.reply_to_message, 'text', None))
+                      and message.reply_to_message.text)
 
-    if is_voice:
-        user_text = None  # will be transcribed below
-    else:
-        user_text = extract_user_text(message, bot_user_id, bot_username)
-        if not user_text and not reply_has_voice and not reply_has_text:
-            logger.debug("Message matched but extracted text is empty, ignoring")
-            return
+    if not is_voice and not user_text and not reply_has_voice and not reply_has_text:
+        logger.debug("Message matched but extracted text is empty, ignoring")
+        return
 
-    if mentioned and not message.reply_to_message:
-        root_id = message.message_id  # new conversation
+    # Telegram only nests reply_to_message one level deep, so the conversation
+    # root comes from the registry. A mention outside a reply starts a new one.
+    replied_to_id = message.reply_to_message.message_id if message.reply_to_message else None
+    root_id, conv, found = await store.begin_turn(chat_id, message.message_id, replied_to_id)
+    if replied_to_id is None:
         logger.info("New conversation: chat=%s msg_id=%s root=%s",
                      chat_id, message.message_id, root_id)
     else:
-        # Look up root from registry (Telegram only nests reply_to_message 1 level deep)
-        replied_to_id = message.reply_to_message.message_id
-        root_id = store.find_root(chat_id, replied_to_id)
-        if root_id is None:
-            root_id = replied_to_id
+        if not found:
             logger.warning("Root not in registry: chat=%s replied_to=%s, falling back to root=%s",
                            chat_id, replied_to_id, root_id)
         logger.info("Continue conversation: chat=%s msg_id=%s root=%s replied_to=%s",
                      chat_id, message.message_id, root_id, replied_to_id)
 
-    # Register user's message so future replies to it can find this conversation
-    store.register_message(chat_id, message.message_id, root_id)
-    logger.info("Registered msg %s -> root %s (registry size: %d)",
-                message.message_id, root_id, store.registry_size())
-
     # Transcribe voice (either the message itself or the replied-to message)
-    voice_file_id = None
+    voice = None
     if is_voice:
-        voice_file_id = message.voice.file_id
+        voice = message.voice
     elif reply_has_voice:
-        voice_file_id = message.reply_to_message.voice.file_id
+        voice = message.reply_to_message.voice
 
-    if voice_file_id:
-        status_msg_id = await _send_status(telegram_token, chat_id, message.message_id,
+    if voice:
+        status_msg_id = await _send_status(http, telegram_token, chat_id, message.message_id,
                                             "Transcribiendo audio...")
         try:
-            transcript = transcriber.transcribe_voice(telegram_token, voice_file_id)
+            transcript = await transcriber.transcribe_voice(telegram_token, voice.file_id, voice.file_unique_id)
         except Exception:
             logger.exception("Transcription failed for chat=%s", chat_id)
-            await _delete_message(telegram_token, chat_id, status_msg_id)
-            await _send_text(telegram_token, chat_id, message.message_id,
+            _in_background(_delete_message(http, telegram_token, chat_id, status_msg_id))
+            await _send_text(http, telegram_token, chat_id, message.message_id,
                              "No pude transcribir el audio. Intenta de nuevo.")
             return
         if not transcript:
-            await _delete_message(telegram_token, chat_id, status_msg_id)
-            await _send_text(telegram_token, chat_id, message.message_id,
+            _in_background(_delete_message(http, telegram_token, chat_id, status_msg_id))
+            await _send_text(http, telegram_token, chat_id, message.message_id,
                              "No pude entender el audio. Intenta de nuevo o escribe tu mensaje.")
             return
         logger.info("Transcribed voice: %r", transcript[:120])
-        await _delete_message(telegram_token, chat_id, status_msg_id)
+        # Nothing waits on the status cleanup; overlap it with the next reply
+        _in_background(_delete_message(http, telegram_token, chat_id, status_msg_id))
 
         if is_voice:
             user_text = transcript
@@ -178,129 +267,252 @@ async def handle_message(
         original_text = message.reply_to_message.text
         user_text = f"[Mensaje original]: {original_text}\n\n{user_text or ''}".strip()
 
-    conv = store.get_or_create(chat_id=chat_id, root_message_id=root_id)
     conv.messages.append({"role": "user", "content": user_text})
     logger.info("Sending to Claude: %d messages, container=%s", len(conv.messages), conv.container_id)
 
     # Pre-assign document number based on user's request
-    year = datetime.now().year
+    year = time.localtime().tm_year
     doc_type = _infer_doc_type(user_text)
     if doc_type:
-        doc_num = store.next_document_number(doc_type, year)
+        doc_num = await store.next_document_number(doc_type, year)
         logger.info("Pre-assigned document number: %s", doc_num)
-        doc_number_context = f"\n\n## Numeración de documentos\nUsa exactamente este número para el documento: **{doc_num}**"
+        doc_number_context = _ASSIGNED_NUMBER_CONTEXT.format(doc_num=doc_num)
     else:
         # No doc type detected — provide last numbers as context for follow-ups
-        last_numbers = store.get_last_document_numbers(year)
-        if last_numbers:
-            lines = [f"\n\n## Numeración de documentos\nÚltimos números generados en {year}:"]
-            for dt, num in sorted(last_numbers.items()):
-                label = DOC_TYPES.get(dt, dt)
-                lines.append(f"- {label}: {num}")
-            lines.append("Si necesitas generar un documento, usa el siguiente número consecutivo.")
-            doc_number_context = "\n".join(lines)
-        else:
-            doc_number_context = f"\n\n## Numeración de documentos\nNo hay documentos generados en {year}. Formato: TIPO-{year}-001 (COT para cotización, PRES para presupuesto, REC para recibo)."
+        last_numbers = await store.get_last_document_numbers(year)
+        doc_number_context = _last_numbers_context(year, tuple(sorted(last_numbers.items())))
 
     try:
-        result = claude.send_message(conv.messages, container_id=conv.container_id,
-                                     system_extra=doc_number_context)
+        result = await claude.send_message(conv.messages,
+                                           container_id=conv.container_id,
+                                           system_extra=doc_number_context)
     except (anthropic.InternalServerError, anthropic.APIConnectionError,
             anthropic.RateLimitError):
         logger.exception("Claude API transient error for chat=%s root=%s", chat_id, root_id)
-        await _send_text(telegram_token, chat_id, message.message_id,
+        await _send_text(http, telegram_token, chat_id, message.message_id,
                          "El servicio de Anthropic está temporalmente sobrecargado. Intenta de nuevo en unos minutos.")
-        conv.messages.pop()
-        store.save(chat_id, root_id, conv)
         return
     except Exception:
         logger.exception("Claude API error for chat=%s root=%s", chat_id, root_id)
-        await _send_text(telegram_token, chat_id, message.message_id,
+        await _send_text(http, telegram_token, chat_id, message.message_id,
                          "Error generando el documento. Intenta de nuevo.")
-        conv.messages.pop()
-        store.save(chat_id, root_id, conv)
         return
 
     conv.container_id = result.container_id
     conv.messages.append({"role": "assistant", "content": result.raw_content})
-    store.save(chat_id, root_id, conv)
     logger.info("Claude response: text_len=%d files=%d container=%s text=%r",
                 len(result.text), len(result.file_ids), result.container_id, result.text[:120])
+    # Persist the turn before sending, so a failed or slow send can't lose it
+    await store.commit_turn(chat_id, root_id, conv.messages[-2:], conv.container_id)
 
-    if result.text:
-        bot_msg_id = await _send_text(telegram_token, chat_id, message.message_id, result.text)
-        logger.info("Text sent: bot_msg_id=%s -> root=%s", bot_msg_id, root_id)
-        if bot_msg_id:
-            store.register_message(chat_id, bot_msg_id, root_id)
-
-    async with httpx.AsyncClient() as http:
-        for file_id in result.file_ids:
-            try:
-                filename, content = claude.download_file(file_id)
-                logger.info("Sending document: %s (%d bytes) to chat=%s", filename, len(content), chat_id)
-                bot_msg_id = await _send_document(http, telegram_token, chat_id, message.message_id,
-                                                   filename, content)
-                logger.info("Document sent: bot_msg_id=%s -> root=%s", bot_msg_id, root_id)
-                if bot_msg_id:
-                    store.register_message(chat_id, bot_msg_id, root_id)
-            except Exception:
-                logger.exception("Failed to download/send file %s", file_id)
-
-
-async def _send_status(token: str, chat_id: int, reply_to: int, text: str) -> int | None:
-    """Send a status message and return its message_id for later deletion."""
-    async with httpx.AsyncClient() as http:
-        resp = await http.post(
-            f"https://api.telegram.org/bot{token}/sendMessage",
-            json={
-                "chat_id": chat_id,
-                "text": text,
-                "reply_to_message_id": reply_to,
-            },
-        )
+    async def _register(bot_msg_ids: list[int]):
+        # Registered as each send lands, so a reply to an early message finds
+        # its conversation while later documents are still uploading
         try:
-            return resp.json()["result"]["message_id"]
-        except (KeyError, TypeError):
-            logger.warning("Could not get status message_id from response")
+            await store.register_messages(chat_id, root_id, bot_msg_ids)
+        except Exception:
+            logger.exception("Could not register msgs %s -> root %s", bot_msg_ids, root_id)
+            return
+        logger.info("Registered msgs %s -> root %s", bot_msg_ids, root_id)
+
+    # Text and documents are independent sends; overlap them so the reply takes
+    # about one round trip instead of one per file.
+    async def _reply_text() -> int | None:
+        if not result.text:
             return None
+        bot_msg_id = await _send_text(http, telegram_token, chat_id, message.message_id, result.text)
+        if bot_msg_id:
+            await _register([bot_msg_id])
+        return bot_msg_id
+
+    text_outcome, docs_outcome = await asyncio.gather(
+        _reply_text(),
+        _send_documents(http, claude, telegram_token, chat_id, message.message_id, result.file_ids,
+                        _register),
+        return_exceptions=True,
+    )
+    if isinstance(text_outcome, BaseException):
+        logger.error("Failed to send text reply", exc_info=text_outcome)
+        text_outcome = None
+    if isinstance(docs_outcome, BaseException):
+        logger.error("Failed to send documents", exc_info=docs_outcome)
+        docs_outcome = []
+    logger.info("Reply sent: text_msg_id=%s doc_msg_ids=%s -> root=%s",
+                text_outcome, docs_outcome, root_id)
+
+
+async def _send_documents(
+    http: httpx.AsyncClient, claude: ClaudeClient, token: str, chat_id: int, reply_to: int,
+    file_ids: list[str], register: Callable[[list[int]], Awaitable[None]],
+) -> list[int]:
+    """Download files in parallel and send them, grouped into albums when there are several.
+
+    register is awaited with each batch's message ids as soon as it is sent.
+    """
+    downloads = await asyncio.gather(
+        *(claude.download_file(file_id) for file_id in file_ids),
+        return_exceptions=True,
+    )
+    documents = []
+    for file_id, download in zip(file_ids, downloads):
+        if isinstance(download, BaseException):
+            logger.error("Failed to download file %s", file_id, exc_info=download)
+            continue
+        logger.info("Sending document: %s to chat=%s", download[0], chat_id)
+        documents.append(download)
+
+    bot_msg_ids = []
+    try:
+        for i in range(0, len(documents), MEDIA_GROUP_MAX):
+            sent = await _send_batch(http, token, chat_id, reply_to, documents[i:i + MEDIA_GROUP_MAX])
+            if sent:
+                await register(sent)
+            bot_msg_ids.extend(sent)
+    finally:
+        for _, content in documents:
+            content.close()
+    return bot_msg_ids
+
+
+async def _send_batch(
+    http: httpx.AsyncClient, token: str, chat_id: int, reply_to: int,
+    batch: list[tuple[str, BinaryIO]],
+) -> list[int]:
+    """Send a batch as one album, falling back to one sendDocument per file.
+
+    Failures are logged per file, so one bad document doesn't lose the others
+    or the message ids of batches already sent.
+    """
+    # Telegram albums need at least two items
+    if len(batch) > 1:
+        try:
+            bot_msg_ids = await _send_media_group(http, token, chat_id, reply_to, batch)
+        except (*_NEVER_SENT, ValueError):
+            logger.exception("sendMediaGroup failed for chat=%s", chat_id)
+            bot_msg_ids = []
+        except httpx.TransportError:
+            # Telegram may have delivered the album; resending would duplicate it
+            logger.exception("sendMediaGroup outcome unknown for chat=%s, not resending", chat_id)
+            return []
+        if bot_msg_ids:
+            return bot_msg_ids
+        logger.warning("Album not sent, sending %d documents one by one", len(batch))
+
+    bot_msg_ids = []
+    for filename, content in batch:
+        try:
+            bot_msg_id = await _send_document(http, token, chat_id, reply_to, filename, content)
+        except (httpx.HTTPError, ValueError):
+            logger.exception("sendDocument failed for %s in chat=%s", filename, chat_id)
+            continue
+        if bot_msg_id:
+            bot_msg_ids.append(bot_msg_id)
+    return bot_msg_ids
+
+
+def _retry_after(resp: httpx.Response) -> float | None:
+    try:
+        return resp.json()["parameters"]["retry_after"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+async def _telegram_post(http: httpx.AsyncClient, url: str, idempotent: bool = False,
+                         **kwargs) -> httpx.Response:
+    """POST to the Bot API, retrying 429 and requests that never left.
+
+    Read/write timeouts and 5xx are only retried for idempotent methods: a
+    send Telegram already accepted would otherwise reach the chat twice.
+    """
+    for attempt in range(TELEGRAM_MAX_RETRIES):
+        final = attempt == TELEGRAM_MAX_RETRIES - 1
+        # Uploads read their file objects to the end; rewind for each attempt
+        for _, content in kwargs.get("files", {}).values():
+            content.seek(0)
+        try:
+            resp = await http.post(url, **kwargs)
+        except httpx.TransportError as e:
+            if final or not (idempotent or isinstance(e, _NEVER_SENT)):
+                raise
+            delay = TELEGRAM_RETRY_DELAYS[attempt]
+            logger.warning("Telegram request error (attempt %d/%d), retrying in %ss: %s",
+                           attempt + 1, TELEGRAM_MAX_RETRIES, delay, e)
+            await asyncio.sleep(delay)
+            continue
+        retryable = resp.status_code == 429 or (idempotent and resp.status_code >= 500)
+        if final or not retryable:
+            return resp
+        delay = (_retry_after(resp) if resp.status_code == 429 else None) or TELEGRAM_RETRY_DELAYS[attempt]
+        logger.warning("Telegram returned %d (attempt %d/%d), retrying in %ss",
+                       resp.status_code, attempt + 1, TELEGRAM_MAX_RETRIES, delay)
+        await asyncio.sleep(delay)
+
+
+async def _send_status(
+    http: httpx.AsyncClient, token: str, chat_id: int, reply_to: int, text: str,
+) -> int | None:
+    """Send a status message and return its message_id for later deletion."""
+    resp = await _telegram_post(
+        http,
+        api_url(token, "sendMessage"),
+        json={
+            "chat_id": chat_id,
+            "text": text,
+            "reply_to_message_id": reply_to,
+        },
+    )
+    try:
+        return resp.json()["result"]["message_id"]
+    except (KeyError, TypeError):
+        logger.warning("Could not get status message_id from response")
+        return None
 
 
-async def _delete_message(token: str, chat_id: int, message_id: int | None):
+async def _delete_message(http: httpx.AsyncClient, token: str, chat_id: int, message_id: int | None):
     """Delete a message. Silently ignores failures."""
     if message_id is None:
         return
-    async with httpx.AsyncClient() as http:
-        await http.post(
-            f"https://api.telegram.org/bot{token}/deleteMessage",
+    try:
+        await _telegram_post(
+            http,
+            api_url(token, "deleteMessage"),
+            idempotent=True,
             json={"chat_id": chat_id, "message_id": message_id},
         )
+    except httpx.HTTPError as e:
+        logger.warning("Could not delete message %s: %s", message_id, e)
 
 
-async def _send_text(token: str, chat_id: int, reply_to: int, text: str) -> int | None:
-    async with httpx.AsyncClient() as http:
-        resp = await http.post(
-            f"https://api.telegram.org/bot{token}/sendMessage",
-            json={
-                "chat_id": chat_id,
-                "text": text,
-                "reply_to_message_id": reply_to,
-                "parse_mode": "Markdown",
-            },
-        )
-        data = resp.json()
-        try:
-            return data["result"]["message_id"]
-        except (KeyError, TypeError):
-            logger.warning("sendMessage failed or missing message_id: %s", data)
-            return None
+async def _send_text(
+    http: httpx.AsyncClient, token: str, chat_id: int, reply_to: int, text: str,
+) -> int | None:
+    url = api_url(token, "sendMessage")
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "reply_to_message_id": reply_to,
+    }
+    resp = await _telegram_post(http, url, json={**payload, "parse_mode": "Markdown"})
+    if resp.status_code == 400:
+        # Claude output often has unbalanced Markdown (_, *, `) that Telegram
+        # refuses to parse; deliver it as plain text rather than dropping it.
+        logger.warning("sendMessage rejected Markdown, retrying as plain text: %s", resp.text)
+        resp = await _telegram_post(http, url, json=payload)
+    data = resp.json()
+    try:
+        return data["result"]["message_id"]
+    except (KeyError, TypeError):
+        logger.warning("sendMessage failed or missing message_id: %s", data)
+        return None
 
 
 async def _send_document(
     http: httpx.AsyncClient, token: str, chat_id: int, reply_to: int,
-    filename: str, content: bytes,
+    filename: str, content: BinaryIO,
 ) -> int | None:
-    resp = await http.post(
-        f"https://api.telegram.org/bot{token}/sendDocument",
+    resp = await _telegram_post(
+        http,
+        api_url(token, "sendDocument"),
         data={"chat_id": chat_id, "reply_to_message_id": reply_to},
         files={"document": (filename, content)},
     )
@@ -310,3 +522,22 @@ async def _send_document(
     except (KeyError, TypeError):
         logger.warning("sendDocument failed or missing message_id: %s", data)
         return None
+
+
+async def _send_media_group(
+    http: httpx.AsyncClient, token: str, chat_id: int, reply_to: int,
+    documents: list[tuple[str, BinaryIO]],
+) -> list[int]:
+    media = [{"type": "document", "media": f"attach://doc{i}"} for i in range(len(documents))]
+    resp = await _telegram_post(
+        http,
+        api_url(token, "sendMediaGroup"),
+        data={"chat_id": chat_id, "reply_to_message_id": reply_to, "media": orjson.dumps(media)},
+        files={f"doc{i}": (filename, content) for i, (filename, content) in enumerate(documents)},
+    )
+    data = resp.json()
+    try:
+        return [m["message_id"] for m in data["result"]]
+    except (KeyError, TypeError):
+        logger.warning("sendMediaGroup failed or missing message_ids: %s", data)
+        return []
@@ -1,6 +1,8 @@
+import asyncio
 import logging
-import time
+import tempfile
 from dataclasses import dataclass, field
+from typing import BinaryIO
 import anthropic
 
 logger = logging.getLogger(__name__)
@@ -49,7 +51,12 @@ Carta de Compromiso:
 - ITBIS solo aplica a cotizaciones, presupuestos y recibos. No aplica a cartas de compromiso."""
 
 BETAS = ["code-execution-2025-08-25", "skills-2025-10-02"]
+TOOLS = [{"type": "code_execution_20250825", "name": "code_execution"}]
+# The static prompt is its own cached block so the per-turn extra (document
+# numbers) sent after it doesn't change the cached prefix bytes.
+SYSTEM_BLOCK = {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
 MAX_CONTINUATIONS = 10
+DOWNLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # downloads above this spill to disk
 
 
 @dataclass
@@ -62,44 +69,44 @@ class ClaudeResponse:
 
 class ClaudeClient:
     def __init__(self, api_key: str, skill_id: str):
-        self._client = anthropic.Anthropic(api_key=api_key)
+        self._client = anthropic.AsyncAnthropic(api_key=api_key)
         self._skill_id = skill_id
+        self._skills = [{"type": "custom", "skill_id": skill_id, "version": "latest"}]
 
     def extract_response(self, response) -> ClaudeResponse:
+        content = list(response.content)
         texts = []
         file_ids = []
-        last_code_exec_idx = -1
 
-        # Find index of last code execution result
-        for i, item in enumerate(response.content):
-            if item.type == "bash_code_execution_tool_result":
-                last_code_exec_idx = i
+        # Only keep text blocks after the last code execution result (earlier
+        # ones are narration); if no code execution happened, keep all of them.
+        for item in content:
+            if item.type == "text":
+                texts.append(item.text)
+            elif item.type == "bash_code_execution_tool_result":
+                texts.clear()
                 content_item = item.content
                 if content_item.type == "bash_code_execution_result":
                     for file in content_item.content:
                         if hasattr(file, "file_id"):
                             file_ids.append(file.file_id)
 
-        # Only keep text blocks after the last code execution result
-        # If no code execution happened, keep all text blocks
-        for i, item in enumerate(response.content):
-            if item.type == "text" and i > last_code_exec_idx:
-                texts.append(item.text)
-
         return ClaudeResponse(
             text="".join(texts),
             file_ids=file_ids,
             container_id=response.container.id if response.container else None,
-            raw_content=list(response.content),
+            # Plain dicts for the history: serialised on every save and
+            # accepted back by the API, so dump each block once here
+            raw_content=[item.model_dump() for item in content],
         )
 
     def needs_continuation(self, response) -> bool:
         return response.stop_reason == "pause_turn"
 
-    def _api_call_with_retry(self, **kwargs):
+    async def _api_call_with_retry(self, **kwargs):
         for attempt in range(MAX_RETRIES):
             try:
-                return self._client.beta.messages.create(**kwargs)
+                return await self._client.beta.messages.create(**kwargs)
             except (anthropic.InternalServerError, anthropic.APIConnectionError,
                     anthropic.RateLimitError) as e:
                 if attempt == MAX_RETRIES - 1:
@@ -107,18 +114,15 @@ class ClaudeClient:
                 delay = RETRY_DELAYS[attempt]
                 logger.warning("Claude API error (attempt %d/%d), retrying in %ds: %s",
                                attempt + 1, MAX_RETRIES, delay, e)
-                time.sleep(delay)
+                await asyncio.sleep(delay)
 
-    def send_message(self, messages: list[dict], container_id: str | None = None,
-                     system_extra: str = "") -> ClaudeResponse:
-        container = {
-            "skills": [{"type": "custom", "skill_id": self._skill_id, "version": "latest"}]
-        }
+    async def send_message(self, messages: list[dict], container_id: str | None = None,
+                           system_extra: str = "") -> ClaudeResponse:
+        container = {"skills": self._skills}
         if container_id:
             container["id"] = container_id
 
-        system_text = SYSTEM_PROMPT + system_extra if system_extra else SYSTEM_PROMPT
-        system = [{"type": "text", "text": system_text, "cache_control": {"type": "ephemeral"}}]
+        system = [SYSTEM_BLOCK, {"type": "text", "text": system_extra}] if system_extra else [SYSTEM_BLOCK]
 
         # Mark the last message for caching (covers conversation history)
         cached_messages = list(messages)
@@ -132,14 +136,14 @@ class ClaudeClient:
                 }
 
         logger.info("Claude API call: %d messages, container=%s", len(messages), container_id)
-        response = self._api_call_with_retry(
+        response = await self._api_call_with_retry(
             model="claude-sonnet-4-6",
             max_tokens=4096,
             betas=BETAS,
             system=system,
             container=container,
             messages=cached_messages,
-            tools=[{"type": "code_execution_20250825", "name": "code_execution"}],
+            tools=TOOLS,
         )
         logger.info("Claude API response: stop_reason=%s", response.stop_reason)
 
@@ -151,26 +155,35 @@ class ClaudeClient:
             continuation += 1
             logger.info("Claude pause_turn, continuing (%d/%d)", continuation, MAX_CONTINUATIONS)
             messages = messages + [{"role": "assistant", "content": response.content}]
-            response = self._api_call_with_retry(
+            response = await self._api_call_with_retry(
                 model="claude-sonnet-4-6",
                 max_tokens=4096,
                 betas=BETAS,
                 system=system,
                 container={"id": response.container.id, **container},
                 messages=messages,
-                tools=[{"type": "code_execution_20250825", "name": "code_execution"}],
+                tools=TOOLS,
             )
             logger.info("Claude continuation response: stop_reason=%s", response.stop_reason)
 
         return self.extract_response(response)
 
-    def download_file(self, file_id: str) -> tuple[str, bytes]:
+    async def download_file(self, file_id: str) -> tuple[str, BinaryIO]:
+        """Stream a Files API file into a spooled temp file, rewound for reading.
+
+        Small files stay in memory, larger ones spill to disk, so the upload can
+        read it in chunks instead of holding a second full copy. The caller closes it.
+        """
         logger.info("Downloading file: %s", file_id)
-        metadata = self._client.beta.files.retrieve_metadata(
+        metadata = await self._client.beta.files.retrieve_metadata(
             file_id=file_id, betas=["files-api-2025-04-14"]
         )
-        content = self._client.beta.files.download(
+        content = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_BYTES)
+        async with self._client.beta.files.with_streaming_response.download(
             file_id=file_id, betas=["files-api-2025-04-14"]
-        )
-        logger.info("File downloaded: %s (%s)", metadata.filename, file_id)
-        return metadata.filename, content.read()
+        ) as response:
+            async for chunk in response.iter_bytes():
+                content.write(chunk)
+        logger.info("File downloaded: %s (%s, %d bytes)", metadata.filename, file_id, content.tell())
+        content.seek(0)
+        return metadata.filename, content
@@ -1,3 +1,4 @@
+import functools
 import os
 from dataclasses import dataclass
 
@@ -12,19 +13,22 @@ class Config:
     soniox_api_key: str
 
 
-_REQUIRED = ["TELEGRAM_BOT_TOKEN", "ANTHROPIC_API_KEY", "RK_SKILL_ID", "WEBHOOK_SECRET", "SONIOX_API_KEY", "DATABASE_URL"]
+_REQUIRED = ("TELEGRAM_BOT_TOKEN", "ANTHROPIC_API_KEY", "RK_SKILL_ID", "WEBHOOK_SECRET", "SONIOX_API_KEY", "DATABASE_URL")
 
 
+# Read once per process; the environment doesn't change under a running app
+@functools.cache
 def load_config() -> Config:
-    missing = [k for k in _REQUIRED if not os.environ.get(k)]
+    env = {k: os.environ.get(k) for k in _REQUIRED}
+    missing = [k for k, v in env.items() if not v]
     if missing:
         raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
 
     return Config(
-        telegram_bot_token=os.environ["TELEGRAM_BOT_TOKEN"],
-        anthropic_api_key=os.environ["ANTHROPIC_API_KEY"],
-        rk_skill_id=os.environ["RK_SKILL_ID"],
-        webhook_secret=os.environ["WEBHOOK_SECRET"],
-        database_url=os.environ["DATABASE_URL"],
-        soniox_api_key=os.environ["SONIOX_API_KEY"],
+        telegram_bot_token=env["TELEGRAM_BOT_TOKEN"],
+        anthropic_api_key=env["ANTHROPIC_API_KEY"],
+        rk_skill_id=env["RK_SKILL_ID"],
+        webhook_secret=env["WEBHOOK_SECRET"],
+        database_url=env["DATABASE_URL"],
+        soniox_api_key=env["SONIOX_API_KEY"],
     )
@@ -1,15 +1,22 @@
+import asyncio
 import functools
-import json
 import logging
-import time
 from dataclasses import dataclass, field
-from typing import Any
 
+import orjson
 import psycopg
-from psycopg_pool import ConnectionPool
+from psycopg.types.json import Jsonb, set_json_dumps, set_json_loads
+from psycopg_pool import AsyncConnectionPool
 
 logger = logging.getLogger(__name__)
 
+# Decode jsonb columns with orjson; the history blobs hold every code-execution result
+set_json_loads(orjson.loads)
+
+# Bump when _CREATE_TABLES or _INDEX_DDL change; startup skips the DDL once the database
+# records this version.
+SCHEMA_VERSION = 5
+
 _CREATE_TABLES = """
 CREATE TABLE IF NOT EXISTS conversations (
     chat_id BIGINT NOT NULL,
@@ -27,15 +34,97 @@ CREATE TABLE IF NOT EXISTS message_registry (
     PRIMARY KEY (chat_id, message_id)
 );
 
-CREATE INDEX IF NOT EXISTS idx_message_registry_root
-    ON message_registry (chat_id, root_message_id);
-
 CREATE TABLE IF NOT EXISTS document_counters (
     doc_type TEXT NOT NULL,
     year INT NOT NULL,
     last_number INT NOT NULL DEFAULT 0,
     PRIMARY KEY (doc_type, year)
 );
+
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY
+);
+"""
+
+# Run one by one outside a transaction with CONCURRENTLY, so changing an index
+# during a rolling deploy doesn't block writes to a live table.
+_INDEX_DDL = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_message_registry_root"
+    " ON message_registry (chat_id, root_message_id)",
+    # Duplicated the (chat_id, message_id) primary key, doubling index writes
+    # per registration for a single-row lookup the key already serves
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_message_registry_lookup",
+    # last_activity changes twice per turn; a btree on it blocked HOT updates
+    # on the hot path just to speed up the once-per-start cleanup scan.
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_conversations_last_activity",
+)
+
+_SAVE_CONVERSATION = """
+UPDATE conversations
+SET messages = %s, container_id = %s, last_activity = NOW()
+WHERE chat_id = %s AND root_message_id = %s
+"""
+
+# Append only the new turn's messages server-side instead of resending the
+# whole history, which grows with every code-execution result.
+_APPEND_TURN = """
+UPDATE conversations
+SET messages = messages || %s, container_id = %s, last_activity = NOW()
+WHERE chat_id = %s AND root_message_id = %s
+"""
+
+_REGISTER_MESSAGE = """
+INSERT INTO message_registry (chat_id, message_id, root_message_id)
+VALUES (%s, %s, %s)
+ON CONFLICT DO NOTHING
+"""
+
+# Resolve the root a message belongs to, register the message under it and
+# upsert that conversation in one round trip. The root is the replied-to
+# message's registered root, else the fallback (the replied-to message, or the
+# message itself for a new conversation).
+_BEGIN_TURN = """
+WITH lookup AS (
+    SELECT root_message_id FROM message_registry
+    WHERE chat_id = %(chat_id)s AND message_id = %(replied_to_id)s
+), root AS (
+    SELECT COALESCE((SELECT root_message_id FROM lookup), %(fallback_id)s) AS root_message_id,
+           EXISTS (SELECT 1 FROM lookup) AS found
+), reg AS (
+    INSERT INTO message_registry (chat_id, message_id, root_message_id)
+    SELECT %(chat_id)s, %(message_id)s, root_message_id FROM root
+    ON CONFLICT DO NOTHING
+), conv AS (
+    INSERT INTO conversations (chat_id, root_message_id, messages, last_activity)
+    SELECT %(chat_id)s, root_message_id, '[]'::jsonb, NOW() FROM root
+    ON CONFLICT (chat_id, root_message_id) DO UPDATE SET last_activity = NOW()
+    RETURNING root_message_id, messages, container_id
+)
+SELECT conv.root_message_id, conv.messages, conv.container_id, root.found FROM conv, root
+"""
+
+CLEANUP_BATCH_SIZE = 1000
+
+# One cleanup batch: expired conversations (skipping rows a concurrent cleanup
+# holds) and the registry rows pointing at them. Returns both counts.
+_CLEANUP_BATCH = """
+WITH victims AS (
+    SELECT ctid FROM conversations
+    WHERE last_activity < NOW() - make_interval(secs => %s)
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+), expired AS (
+    DELETE FROM conversations
+    WHERE ctid IN (SELECT ctid FROM victims)
+    RETURNING chat_id, root_message_id
+), reg AS (
+    DELETE FROM message_registry
+    USING expired
+    WHERE message_registry.chat_id = expired.chat_id
+      AND message_registry.root_message_id = expired.root_message_id
+    RETURNING 1
+)
+SELECT (SELECT COUNT(*) FROM expired), (SELECT COUNT(*) FROM reg)
 """
 
 DOC_TYPES = {"COT": "Cotización", "PRES": "Presupuesto", "REC": "Recibo", "CARTA": "Carta de Compromiso"}
@@ -44,21 +133,18 @@ DOC_TYPES = {"COT": "Cotización", "PRES": "Presupuesto", "REC": "Recibo", "CART
 def _retry_on_disconnect(method):
     """Retry a method once if the database connection was lost."""
     @functools.wraps(method)
-    def wrapper(self, *args, **kwargs):
+    async def wrapper(self, *args, **kwargs):
         try:
-            return method(self, *args, **kwargs)
+            return await method(self, *args, **kwargs)
         except psycopg.OperationalError as e:
             logger.warning("Database connection lost (%s), retrying...", e)
-            time.sleep(0.5)
-            return method(self, *args, **kwargs)
+            await asyncio.sleep(0.5)
+            return await method(self, *args, **kwargs)
     return wrapper
 
 
-def _json_default(obj: Any) -> Any:
-    """Serialize Anthropic SDK objects (BetaTextBlock, etc.) to dicts."""
-    if hasattr(obj, "model_dump"):
-        return obj.model_dump()
-    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+# Encode every Jsonb parameter with orjson as well; history is stored as plain dicts
+set_json_dumps(orjson.dumps)
 
 
 @dataclass
@@ -67,24 +153,54 @@ class Conversation:
     container_id: str | None = None
 
 
+def _save_params(chat_id: int, root_message_id: int, conv: Conversation) -> tuple:
+    return (Jsonb(conv.messages), conv.container_id, chat_id, root_message_id)
+
+
 class ConversationStore:
     def __init__(self, database_url: str, ttl_seconds: int = 86400):
-        self._pool = ConnectionPool(
+        # Opened by open() once an event loop is running. No per-checkout
+        # check: that costs a round trip on every query. Idle connections are
+        # recycled instead, and _retry_on_disconnect covers dropped sockets.
+        self._pool = AsyncConnectionPool(
             conninfo=database_url,
             min_size=1,
-            max_size=4,
-            check=ConnectionPool.check_connection,
-            kwargs={"autocommit": True},
+            max_size=8,
+            max_idle=300,
+            # Prepare every statement on first use; the same handful of
+            # queries run on every turn, so the server parses/plans them once.
+            kwargs={"autocommit": True, "prepare_threshold": 0},
+            open=False,
         )
         self._ttl = ttl_seconds
-        with self._pool.connection() as conn:
-            conn.execute(_CREATE_TABLES)
-        logger.info("ConversationStore: tables ensured")
+
+    async def open(self):
+        await self._pool.open()
+        async with self._pool.connection() as conn:
+            try:
+                row = await (await conn.execute("SELECT MAX(version) FROM schema_version")).fetchone()
+                current = row[0]
+            except psycopg.errors.UndefinedTable:
+                current = None
+            if current is not None and current >= SCHEMA_VERSION:
+                logger.info("ConversationStore: schema at version %s", current)
+                return
+            async with conn.transaction():
+                # Several statements in one string can't be prepared
+                await conn.execute(_CREATE_TABLES, prepare=False)
+            for ddl in _INDEX_DDL:
+                await conn.execute(ddl, prepare=False)
+            await conn.execute("INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING",
+                               (SCHEMA_VERSION,))
+        logger.info("ConversationStore: tables ensured (schema version %s)", SCHEMA_VERSION)
+
+    async def close(self):
+        await self._pool.close()
 
     @_retry_on_disconnect
-    def get_or_create(self, chat_id: int, root_message_id: int) -> Conversation:
-        with self._pool.connection() as conn:
-            row = conn.execute(
+    async def get_or_create(self, chat_id: int, root_message_id: int) -> Conversation:
+        async with self._pool.connection() as conn:
+            row = await (await conn.execute(
                 """
                 INSERT INTO conversations (chat_id, root_message_id, messages, last_activity)
                 VALUES (%s, %s, '[]'::jsonb, NOW())
@@ -92,73 +208,88 @@ class ConversationStore:
                 RETURNING messages, container_id
                 """,
                 (chat_id, root_message_id),
-            ).fetchone()
-        messages = json.loads(row[0]) if isinstance(row[0], str) else row[0]
-        return Conversation(messages=messages, container_id=row[1])
+            )).fetchone()
+        return Conversation(messages=row[0], container_id=row[1])
 
     @_retry_on_disconnect
-    def save(self, chat_id: int, root_message_id: int, conv: Conversation):
-        with self._pool.connection() as conn:
-            conn.execute(
-                """
-                UPDATE conversations
-                SET messages = %s::jsonb, container_id = %s, last_activity = NOW()
-                WHERE chat_id = %s AND root_message_id = %s
-                """,
-                (json.dumps(conv.messages, default=_json_default), conv.container_id, chat_id, root_message_id),
-            )
+    async def begin_turn(self, chat_id: int, message_id: int,
+                         replied_to_id: int | None) -> tuple[int, Conversation, bool]:
+        """Register message_id and load its conversation in one statement.
+
+        Returns (root_message_id, conversation, found), where found is False
+        when replied_to_id had no registered root and the fallback was used.
+        """
+        async with self._pool.connection() as conn:
+            row = await (await conn.execute(_BEGIN_TURN, {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "replied_to_id": replied_to_id,
+                "fallback_id": replied_to_id if replied_to_id is not None else message_id,
+            })).fetchone()
+        return row[0], Conversation(messages=row[1], container_id=row[2]), row[3]
 
     @_retry_on_disconnect
-    def register_message(self, chat_id: int, message_id: int, root_message_id: int):
-        with self._pool.connection() as conn:
-            conn.execute(
-                """
-                INSERT INTO message_registry (chat_id, message_id, root_message_id)
-                VALUES (%s, %s, %s)
-                ON CONFLICT DO NOTHING
-                """,
-                (chat_id, message_id, root_message_id),
-            )
+    async def save(self, chat_id: int, root_message_id: int, conv: Conversation):
+        async with self._pool.connection() as conn:
+            await conn.execute(_SAVE_CONVERSATION, _save_params(chat_id, root_message_id, conv))
 
     @_retry_on_disconnect
-    def find_root(self, chat_id: int, message_id: int) -> int | None:
-        with self._pool.connection() as conn:
-            row = conn.execute(
+    async def register_message(self, chat_id: int, message_id: int, root_message_id: int):
+        async with self._pool.connection() as conn:
+            await conn.execute(_REGISTER_MESSAGE, (chat_id, message_id, root_message_id))
+
+    # Not retried on disconnect: the append isn't idempotent, and a connection
+    # dropped after the server committed would store the turn twice.
+    async def commit_turn(self, chat_id: int, root_message_id: int, turn: list[dict],
+                          container_id: str | None):
+        """Append a turn's messages to the conversation and record its container."""
+        async with self._pool.connection() as conn:
+            await conn.execute(_APPEND_TURN, (Jsonb(turn), container_id, chat_id, root_message_id))
+
+    @_retry_on_disconnect
+    async def register_messages(self, chat_id: int, root_message_id: int, message_ids: list[int]):
+        """Map several messages to a root; pipelined so the inserts share one round trip."""
+        async with self._pool.connection() as conn, conn.pipeline(), conn.cursor() as cur:
+            await cur.executemany(_REGISTER_MESSAGE,
+                                  [(chat_id, message_id, root_message_id) for message_id in message_ids])
+
+    @_retry_on_disconnect
+    async def find_root(self, chat_id: int, message_id: int) -> int | None:
+        async with self._pool.connection() as conn:
+            row = await (await conn.execute(
                 "SELECT root_message_id FROM message_registry WHERE chat_id = %s AND message_id = %s",
                 (chat_id, message_id),
-            ).fetchone()
+            )).fetchone()
         return row[0] if row else None
 
     @_retry_on_disconnect
-    def cleanup(self):
-        with self._pool.connection() as conn:
-            result = conn.execute(
-                """
-                WITH expired AS (
-                    DELETE FROM conversations
-                    WHERE last_activity < NOW() - make_interval(secs => %s)
-                    RETURNING chat_id, root_message_id
-                )
-                DELETE FROM message_registry
-                USING expired
-                WHERE message_registry.chat_id = expired.chat_id
-                  AND message_registry.root_message_id = expired.root_message_id
-                """,
-                (self._ttl,),
-            )
-            if result.rowcount:
-                logger.info("Cleaned up expired conversations/registry entries")
+    async def cleanup(self):
+        """Delete expired conversations and their registry rows in batches.
+
+        Each batch is its own short transaction on a freshly checked-out
+        connection, so a large backlog never holds locks for the whole sweep.
+        """
+        conversations = registry = 0
+        while True:
+            async with self._pool.connection() as conn:
+                row = await (await conn.execute(_CLEANUP_BATCH, (self._ttl, CLEANUP_BATCH_SIZE))).fetchone()
+            conversations += row[0]
+            registry += row[1]
+            if row[0] < CLEANUP_BATCH_SIZE:
+                break
+        if conversations:
+            logger.info("Cleaned up %d expired conversations, %d registry entries", conversations, registry)
 
     @_retry_on_disconnect
-    def registry_size(self) -> int:
-        with self._pool.connection() as conn:
-            row = conn.execute("SELECT COUNT(*) FROM message_registry").fetchone()
+    async def registry_size(self) -> int:
+        async with self._pool.connection() as conn:
+            row = await (await conn.execute("SELECT COUNT(*) FROM message_registry")).fetchone()
         return row[0]
 
     @_retry_on_disconnect
-    def next_document_number(self, doc_type: str, year: int) -> str:
-        with self._pool.connection() as conn:
-            row = conn.execute(
+    async def next_document_number(self, doc_type: str, year: int) -> str:
+        async with self._pool.connection() as conn:
+            row = await (await conn.execute(
                 """
                 INSERT INTO document_counters (doc_type, year, last_number)
                 VALUES (%s, %s, 1)
@@ -166,14 +297,14 @@ class ConversationStore:
                 RETURNING last_number
                 """,
                 (doc_type, year),
-            ).fetchone()
+            )).fetchone()
         return f"{doc_type}-{year}-{row[0]:03d}"
 
     @_retry_on_disconnect
-    def get_last_document_numbers(self, year: int) -> dict[str, str]:
-        with self._pool.connection() as conn:
-            rows = conn.execute(
+    async def get_last_document_numbers(self, year: int) -> dict[str, str]:
+        async with self._pool.connection() as conn:
+            rows = await (await conn.execute(
                 "SELECT doc_type, last_number FROM document_counters WHERE year = %s",
                 (year,),
-            ).fetchall()
+            )).fetchall()
         return {row[0]: f"{row[0]}-{year}-{row[1]:03d}" for row in rows}
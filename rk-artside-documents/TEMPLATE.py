@@ -12,6 +12,7 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import Paragraph, Frame
 from reportlab.lib.enums import TA_JUSTIFY
 from datetime import datetime
+from functools import lru_cache
 
 # Brand Colors
 GOLD = HexColor('#9A8455')
@@ -24,6 +25,24 @@ WHITE = HexColor('#FFFFFF')
 LOGO_PATH = '/home/claude/logo.png'
 STAMP_PATH = '/home/claude/sello.png'
 
+# Paragraph style for letter bodies (shared by every document)
+BODY_STYLE = ParagraphStyle(
+    'CustomBody',
+    parent=getSampleStyleSheet()['Normal'],
+    fontSize=10,
+    leading=14,
+    textColor=DARK,
+    alignment=TA_JUSTIFY,
+    spaceBefore=0,
+    spaceAfter=12,
+)
+
+
+@lru_cache(maxsize=None)
+def load_image(path):
+    """Decode an asset once and reuse it for every document in this run."""
+    return ImageReader(path)
+
 
 class RKDocument:
     """Base class for RK ArtSide documents."""
@@ -44,7 +63,7 @@ class RKDocument:
         self.c.rect(0, self.height - 120, self.width, 120, fill=True, stroke=False)
         
         # Logo
-        logo = ImageReader(LOGO_PATH)
+        logo = load_image(LOGO_PATH)
         self.c.drawImage(logo, 50, self.height - 90, width=150, height=60,
                         preserveAspectRatio=True, mask='auto')
         
@@ -296,7 +315,7 @@ class RKDocument:
             y: Y position for stamp. If None, uses current y_pos.
             size: Size of stamp in pixels (default 120, use 80 for commitment letters)
         """
-        stamp = ImageReader(STAMP_PATH)
+        stamp = load_image(STAMP_PATH)
         stamp_y = y if y is not None else self.y_pos - size
         # Position further to the right for smaller stamps
         x_offset = 200 if size >= 100 else 150
@@ -314,26 +333,14 @@ class RKDocument:
         Returns:
             Final Y position after drawing paragraphs
         """
-        styles = getSampleStyleSheet()
-        body_style = ParagraphStyle(
-            'CustomBody',
-            parent=styles['Normal'],
-            fontSize=10,
-            leading=14,
-            textColor=DARK,
-            alignment=TA_JUSTIFY,
-            spaceBefore=0,
-            spaceAfter=12,
-        )
-
         available_width = self.width - 100
         margin_bottom = y_end
         current_y = y_start
 
         for para_text in paragraphs:
-            p = Paragraph(para_text, body_style)
+            p = Paragraph(para_text, BODY_STYLE)
             w, h = p.wrap(available_width, 10000)
-            needed = h + body_style.spaceAfter
+            needed = h + BODY_STYLE.spaceAfter
 
             # Check if paragraph fits on current page
             if current_y - needed < margin_bottom:
@@ -21,14 +21,15 @@ def main():
         print("Error: Set TELEGRAM_BOT_TOKEN and WEBHOOK_SECRET env vars")
         sys.exit(1)
 
-    response = httpx.post(
-        f"https://api.telegram.org/bot{token}/setWebhook",
-        json={
-            "url": f"{app_url}/webhook",
-            "secret_token": secret,
-            "allowed_updates": ["message"],
-        },
-    )
+    with httpx.Client(timeout=10.0) as client:
+        response = client.post(
+            f"https://api.telegram.org/bot{token}/setWebhook",
+            json={
+                "url": f"{app_url}/webhook",
+                "secret_token": secret,
+                "allowed_updates": ["message"],
+            },
+        )
 
     result = response.json()
     if result.get("ok"):
@@ -0,0 +1,7 @@
+import functools
+
+
+@functools.lru_cache(maxsize=16)
+def api_url(token: str, method: str) -> str:
+    """Bot API URL for a method; the token is fixed for the process, so each is built once."""
+    return f"https://api.telegram.org/bot{token}/{method}"
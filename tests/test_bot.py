@@ -1,8 +1,14 @@
+import asyncio
+import io
+from types import SimpleNamespace
+import httpx
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch, call
+import bot
 from bot import (
-    is_bot_mentioned, is_reply_to_bot, extract_user_text,
-    find_root_message_id, handle_message, _send_status, _delete_message,
+    is_bot_mentioned, is_reply_to_bot, extract_user_text, scan_entities,
+    handle_message, _send_status, _delete_message, _send_text, _infer_doc_type,
+    _last_numbers_context,
 )
 from claude_client import ClaudeResponse
 from conversations import Conversation
@@ -29,33 +35,56 @@ def _mock_store():
     def registry_size():
         return len(_registry)
 
-    store.get_or_create = MagicMock(side_effect=get_or_create)
-    store.register_message = MagicMock(side_effect=register_message)
-    store.find_root = MagicMock(side_effect=find_root)
-    store.save = MagicMock()
-    store.registry_size = MagicMock(side_effect=registry_size)
+    def begin_turn(chat_id, message_id, replied_to_id):
+        root_id = find_root(chat_id, replied_to_id)
+        found = root_id is not None
+        if not found:
+            root_id = replied_to_id if replied_to_id is not None else message_id
+        _registry.setdefault((chat_id, message_id), root_id)
+        stored = get_or_create(chat_id, root_id)
+        # Hand out a copy, like a fresh row from the database
+        return root_id, Conversation(list(stored.messages), stored.container_id), found
+
+    def commit_turn(chat_id, root_message_id, turn, container_id):
+        stored = get_or_create(chat_id, root_message_id)
+        stored.messages.extend(turn)
+        stored.container_id = container_id
+
+    def register_messages(chat_id, root_message_id, message_ids):
+        for message_id in message_ids:
+            register_message(chat_id, message_id, root_message_id)
+
+    store.get_or_create = AsyncMock(side_effect=get_or_create)
+    store.register_message = AsyncMock(side_effect=register_message)
+    store.find_root = AsyncMock(side_effect=find_root)
+    store.save = AsyncMock()
+    store.next_document_number = AsyncMock(return_value="COT-2026-001")
+    store.get_last_document_numbers = AsyncMock(return_value={})
+    store.registry_size = AsyncMock(side_effect=registry_size)
+    store.begin_turn = AsyncMock(side_effect=begin_turn)
+    store.commit_turn = AsyncMock(side_effect=commit_turn)
+    store.register_messages = AsyncMock(side_effect=register_messages)
     store._convs = _convs
     store._registry = _registry
     return store
 
 
+def _mock_claude():
+    """Create a mock ClaudeClient with coroutine API methods."""
+    claude = MagicMock()
+    claude.send_message = AsyncMock()
+    claude.download_file = AsyncMock()
+    return claude
+
+
 def _make_message(text="", entities=None, reply_to=None, message_id=1):
-    msg = MagicMock()
-    msg.text = text
-    msg.message_id = message_id
-    msg.entities = entities or []
-    msg.reply_to_message = reply_to
-    msg.voice = None
-    return msg
+    # Plain attribute bags: the code under test only reads these fields
+    return SimpleNamespace(text=text, message_id=message_id, entities=entities or [],
+                           reply_to_message=reply_to, voice=None)
 
 
 def _make_entity(entity_type, offset=0, length=0, user=None):
-    entity = MagicMock()
-    entity.type = entity_type
-    entity.offset = offset
-    entity.length = length
-    entity.user = user
-    return entity
+    return SimpleNamespace(type=entity_type, offset=offset, length=length, user=user)
 
 
 # --- is_bot_mentioned ---
@@ -64,45 +93,89 @@ def test_is_bot_mentioned_by_username():
     """@username mention: entity type=mention, no user field."""
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@rkartside_bot cotización", entities=[entity])
-    assert is_bot_mentioned(msg, bot_user_id=123, bot_username="rkartside_bot") is True
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is True
 
 
 def test_is_bot_mentioned_by_username_case_insensitive():
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@RkArtSide_Bot cotización", entities=[entity])
-    assert is_bot_mentioned(msg, bot_user_id=123, bot_username="rkartside_bot") is True
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is True
 
 
 def test_is_bot_mentioned_by_text_mention():
     """text_mention: user without username, has e.user."""
-    entity = _make_entity("text_mention", offset=0, length=8, user=MagicMock(id=123))
+    entity = _make_entity("text_mention", offset=0, length=8, user=SimpleNamespace(id=123))
     msg = _make_message(text="rk-tools cotización", entities=[entity])
-    assert is_bot_mentioned(msg, bot_user_id=123, bot_username="rkartside_bot") is True
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is True
+
+
+def test_is_bot_mentioned_after_emoji_uses_utf16_offsets():
+    """Telegram offsets count UTF-16 units; the emoji takes two of them."""
+    entity = _make_entity("mention", offset=3, length=14, user=None)
+    msg = _make_message(text="😀 @rkartside_bot hola", entities=[entity])
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is True
 
 
 def test_is_bot_mentioned_false_different_username():
     entity = _make_entity("mention", offset=0, length=8, user=None)
     msg = _make_message(text="@someone hello", entities=[entity])
-    assert is_bot_mentioned(msg, bot_user_id=123, bot_username="rkartside_bot") is False
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is False
 
 
 def test_is_bot_mentioned_false_no_entities():
     msg = _make_message(text="hello")
-    assert is_bot_mentioned(msg, bot_user_id=123, bot_username="rkartside_bot") is False
+    assert is_bot_mentioned(msg, bot_user_id=123, bot_mention="@rkartside_bot") is False
+
+
+# --- _infer_doc_type ---
+
+def test_infer_doc_type_matches_keyword_case_insensitive():
+    assert _infer_doc_type("Necesito una COTIZACIÓN para Ana") == "COT"
+    assert _infer_doc_type("recibo de pago") == "REC"
+
+
+def test_infer_doc_type_prefers_declared_order():
+    assert _infer_doc_type("carta de compromiso y presupuesto") == "PRES"
+
+
+def test_infer_doc_type_handles_unicode_case_folding():
+    # "ſ" (long s) matches "s" case-insensitively but doesn't lower-case to it
+    assert _infer_doc_type("preſupuesto para Ana") == "PRES"
+
+
+def test_infer_doc_type_none_without_keywords():
+    assert _infer_doc_type("hola, ¿cómo estás?") is None
+
+
+# --- _last_numbers_context ---
+
+def test_last_numbers_context_lists_numbers_with_labels():
+    context = _last_numbers_context(2026, (("COT", "COT-2026-004"), ("REC", "REC-2026-001")))
+    assert "- Cotización: COT-2026-004" in context
+    assert "- Recibo: REC-2026-001" in context
+
+
+def test_last_numbers_context_without_numbers_explains_format():
+    context = _last_numbers_context(2026, ())
+    assert "No hay documentos generados en 2026" in context
 
 
 # --- is_reply_to_bot ---
 
 def test_is_reply_to_bot_true():
-    reply = MagicMock()
-    reply.from_user = MagicMock(id=123)
+    reply = SimpleNamespace(from_user=SimpleNamespace(id=123))
     msg = _make_message(reply_to=reply)
     assert is_reply_to_bot(msg, bot_user_id=123) is True
 
 
 def test_is_reply_to_bot_false():
-    reply = MagicMock()
-    reply.from_user = MagicMock(id=999)
+    reply = SimpleNamespace(from_user=SimpleNamespace(id=999))
+    msg = _make_message(reply_to=reply)
+    assert is_reply_to_bot(msg, bot_user_id=123) is False
+
+
+def test_is_reply_to_bot_false_for_anonymous_post():
+    reply = SimpleNamespace(from_user=None, sender_chat=SimpleNamespace(id=-100))
     msg = _make_message(reply_to=reply)
     assert is_reply_to_bot(msg, bot_user_id=123) is False
 
@@ -117,89 +190,139 @@ def test_is_reply_to_bot_no_reply():
 def test_extract_user_text_strips_username_mention():
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@rkartside_bot cotización para María", entities=[entity])
-    result = extract_user_text(msg, bot_user_id=123, bot_username="rkartside_bot")
+    result = extract_user_text(msg, bot_user_id=123, bot_mention="@rkartside_bot")
     assert result == "cotización para María"
 
 
 def test_extract_user_text_strips_text_mention():
-    entity = _make_entity("text_mention", offset=0, length=8, user=MagicMock(id=123))
+    entity = _make_entity("text_mention", offset=0, length=8, user=SimpleNamespace(id=123))
     msg = _make_message(text="rk-tools cotización para María", entities=[entity])
-    result = extract_user_text(msg, bot_user_id=123, bot_username="rkartside_bot")
+    result = extract_user_text(msg, bot_user_id=123, bot_mention="@rkartside_bot")
     assert result == "cotización para María"
 
 
+def test_extract_user_text_strips_multiple_mentions():
+    first = _make_entity("mention", offset=0, length=14, user=None)
+    second = _make_entity("mention", offset=26, length=14, user=None)
+    msg = _make_message(text="@rkartside_bot cotización @rkartside_bot para María",
+                        entities=[first, second])
+    result = extract_user_text(msg, bot_user_id=123, bot_mention="@rkartside_bot")
+    assert result == "cotización  para María"
+
+
+def test_extract_user_text_after_emoji():
+    entity = _make_entity("mention", offset=3, length=14, user=None)
+    msg = _make_message(text="😀 @rkartside_bot recibo para Luis", entities=[entity])
+    result = extract_user_text(msg, bot_user_id=123, bot_mention="@rkartside_bot")
+    assert result == "😀  recibo para Luis"
+
+
 def test_extract_user_text_no_mention():
     msg = _make_message(text="sí, incluye ITBIS")
-    result = extract_user_text(msg, bot_user_id=123, bot_username="rkartside_bot")
+    result = extract_user_text(msg, bot_user_id=123, bot_mention="@rkartside_bot")
     assert result == "sí, incluye ITBIS"
 
 
-# --- find_root_message_id ---
-
-def test_find_root_message_id_no_reply():
-    msg = _make_message(message_id=100, reply_to=None)
-    assert find_root_message_id(msg) == 100
-
+def test_scan_entities_reports_mention_and_stripped_text():
+    entities = [
+        _make_entity("mention", offset=0, length=8, user=None),
+        _make_entity("mention", offset=9, length=14, user=None),
+    ]
+    msg = _make_message(text="@someone @rkartside_bot recibo", entities=entities)
+    assert scan_entities(msg, bot_user_id=123, bot_mention="@rkartside_bot") == (True, "@someone  recibo")
 
-def test_find_root_message_id_with_reply_chain():
-    root = _make_message(message_id=100, reply_to=None)
-    mid = _make_message(message_id=101, reply_to=root)
-    leaf = _make_message(message_id=102, reply_to=mid)
-    assert find_root_message_id(leaf) == 100
+    msg = _make_message(text="@someone recibo", entities=entities[:1])
+    assert scan_entities(msg, bot_user_id=123, bot_mention="@rkartside_bot") == (False, "@someone recibo")
 
 
 # --- _send_status ---
 
-@pytest.mark.asyncio
 async def test_send_status_returns_message_id():
-    mock_resp = MagicMock()
+    mock_resp = MagicMock(status_code=200)
     mock_resp.json.return_value = {"ok": True, "result": {"message_id": 999}}
 
     mock_http = AsyncMock()
     mock_http.post.return_value = mock_resp
 
-    with patch("bot.httpx.AsyncClient") as mock_client_cls:
-        mock_client_cls.return_value.__aenter__ = AsyncMock(return_value=mock_http)
-        mock_client_cls.return_value.__aexit__ = AsyncMock(return_value=False)
-        result = await _send_status("tok", 1, 2, "Working...")
+    result = await _send_status(mock_http, "tok", 1, 2, "Working...")
 
     assert result == 999
 
 
-@pytest.mark.asyncio
 async def test_send_status_returns_none_on_bad_response():
-    mock_resp = MagicMock()
+    mock_resp = MagicMock(status_code=200)
     mock_resp.json.return_value = {"ok": False}
 
     mock_http = AsyncMock()
     mock_http.post.return_value = mock_resp
 
-    with patch("bot.httpx.AsyncClient") as mock_client_cls:
-        mock_client_cls.return_value.__aenter__ = AsyncMock(return_value=mock_http)
-        mock_client_cls.return_value.__aexit__ = AsyncMock(return_value=False)
-        result = await _send_status("tok", 1, 2, "Working...")
+    result = await _send_status(mock_http, "tok", 1, 2, "Working...")
 
     assert result is None
 
 
+async def test_telegram_post_retries_rate_limit_and_timeout(monkeypatch):
+    sleep = AsyncMock()
+    monkeypatch.setattr("bot.asyncio.sleep", sleep)
+    limited = MagicMock(status_code=429)
+    limited.json.return_value = {"ok": False, "parameters": {"retry_after": 3}}
+    ok_resp = MagicMock(status_code=200)
+    ok_resp.json.return_value = {"ok": True, "result": {"message_id": 999}}
+
+    mock_http = AsyncMock()
+    mock_http.post.side_effect = [limited, httpx.ConnectTimeout("unreachable"), ok_resp]
+
+    result = await _send_status(mock_http, "tok", 1, 2, "Working...")
+
+    assert result == 999
+    assert mock_http.post.call_count == 3
+    assert [c.args[0] for c in sleep.call_args_list] == [3, 1]
+
+
+async def test_telegram_post_does_not_resend_after_read_timeout(monkeypatch):
+    """The send may already have reached the chat; retrying would duplicate it."""
+    monkeypatch.setattr("bot.asyncio.sleep", AsyncMock())
+    mock_http = AsyncMock()
+    mock_http.post.side_effect = httpx.ReadTimeout("slow")
+
+    with pytest.raises(httpx.ReadTimeout):
+        await _send_status(mock_http, "tok", 1, 2, "Working...")
+
+    assert mock_http.post.call_count == 1
+
+
+# --- _send_text ---
+
+async def test_send_text_retries_without_markdown_on_400():
+    bad_resp = MagicMock(status_code=400, text="can't parse entities")
+    ok_resp = MagicMock(status_code=200)
+    ok_resp.json.return_value = {"ok": True, "result": {"message_id": 321}}
+
+    mock_http = AsyncMock()
+    mock_http.post.side_effect = [bad_resp, ok_resp]
+
+    result = await _send_text(mock_http, "tok", 1, 2, "total *RD$ 5_000")
+
+    assert result == 321
+    first, second = mock_http.post.call_args_list
+    assert first[1]["json"]["parse_mode"] == "Markdown"
+    assert "parse_mode" not in second[1]["json"]
+
+
 # --- _delete_message ---
 
-@pytest.mark.asyncio
 async def test_delete_message_skips_none():
     """Should not make any HTTP call when message_id is None."""
-    with patch("bot.httpx.AsyncClient") as mock_client_cls:
-        await _delete_message("tok", 1, None)
-        mock_client_cls.assert_not_called()
+    mock_http = AsyncMock()
+    await _delete_message(mock_http, "tok", 1, None)
+    mock_http.post.assert_not_called()
 
 
-@pytest.mark.asyncio
 async def test_delete_message_calls_api():
     mock_http = AsyncMock()
+    mock_http.post.return_value = MagicMock(status_code=200)
 
-    with patch("bot.httpx.AsyncClient") as mock_client_cls:
-        mock_client_cls.return_value.__aenter__ = AsyncMock(return_value=mock_http)
-        mock_client_cls.return_value.__aexit__ = AsyncMock(return_value=False)
-        await _delete_message("tok", 123, 456)
+    await _delete_message(mock_http, "tok", 123, 456)
 
     mock_http.post.assert_called_once()
     call_args = mock_http.post.call_args
@@ -209,33 +332,32 @@ async def test_delete_message_calls_api():
 
 # --- handle_message integration ---
 
-@pytest.mark.asyncio
 async def test_handle_message_sends_status_then_text_then_file():
     """Verify order: status msg sent, then deleted, then text, then files."""
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@rkartside_bot cotización", entities=[entity], message_id=10)
-    msg.chat = MagicMock(id=1)
+    msg.chat = SimpleNamespace(id=1)
     msg.reply_to_message = None
 
-    claude = MagicMock()
+    claude = _mock_claude()
     claude.send_message.return_value = ClaudeResponse(
         text="Tu cotización:", file_ids=["file_1"],
         container_id="c1", raw_content=[],
     )
-    claude.download_file.return_value = ("cotizacion.pdf", b"pdf-bytes")
+    claude.download_file.return_value = ("cotizacion.pdf", io.BytesIO(b"pdf-bytes"))
 
     store = _mock_store()
 
     calls = []
 
-    async def mock_send_status(token, chat_id, reply_to, text):
+    async def mock_send_status(http, token, chat_id, reply_to, text):
         calls.append(("status", text))
         return 999
 
-    async def mock_delete_message(token, chat_id, message_id):
+    async def mock_delete_message(http, token, chat_id, message_id):
         calls.append(("delete", message_id))
 
-    async def mock_send_text(token, chat_id, reply_to, text):
+    async def mock_send_text(http, token, chat_id, reply_to, text):
         calls.append(("text", text))
         return 500  # bot's text message_id
 
@@ -248,8 +370,9 @@ async def test_handle_message_sends_status_then_text_then_file():
          patch("bot._send_text", mock_send_text), \
          patch("bot._send_document", mock_send_document):
         await handle_message(
-            message=msg, bot_user_id=123, bot_username="rkartside_bot",
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
             claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
         )
 
     assert calls == [
@@ -257,33 +380,32 @@ async def test_handle_message_sends_status_then_text_then_file():
         ("document", "cotizacion.pdf"),
     ]
     # Bot replies should be registered for conversation continuity
-    assert store.find_root(1, 500) == 10  # text msg mapped to root
-    assert store.find_root(1, 501) == 10  # document msg mapped to root
+    assert await store.find_root(1, 500) == 10  # text msg mapped to root
+    assert await store.find_root(1, 501) == 10  # document msg mapped to root
 
 
-@pytest.mark.asyncio
 async def test_handle_message_deletes_status_on_error():
     """On Claude API error, status message should be deleted before error msg."""
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@rkartside_bot cotización", entities=[entity], message_id=10)
-    msg.chat = MagicMock(id=1)
+    msg.chat = SimpleNamespace(id=1)
     msg.reply_to_message = None
 
-    claude = MagicMock()
+    claude = _mock_claude()
     claude.send_message.side_effect = RuntimeError("API down")
 
     store = _mock_store()
 
     calls = []
 
-    async def mock_send_status(token, chat_id, reply_to, text):
+    async def mock_send_status(http, token, chat_id, reply_to, text):
         calls.append(("status", text))
         return 888
 
-    async def mock_delete_message(token, chat_id, message_id):
+    async def mock_delete_message(http, token, chat_id, message_id):
         calls.append(("delete", message_id))
 
-    async def mock_send_text(token, chat_id, reply_to, text):
+    async def mock_send_text(http, token, chat_id, reply_to, text):
         calls.append(("text", text))
         return 501
 
@@ -291,8 +413,9 @@ async def test_handle_message_deletes_status_on_error():
          patch("bot._delete_message", mock_delete_message), \
          patch("bot._send_text", mock_send_text):
         await handle_message(
-            message=msg, bot_user_id=123, bot_username="rkartside_bot",
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
             claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
         )
 
     assert calls == [
@@ -300,7 +423,6 @@ async def test_handle_message_deletes_status_on_error():
     ]
 
 
-@pytest.mark.asyncio
 async def test_handle_message_reply_continues_conversation():
     """Replying to a bot message should continue the same conversation via registry."""
     store = _mock_store()
@@ -308,22 +430,22 @@ async def test_handle_message_reply_continues_conversation():
     # Step 1: User @mentions bot (new conversation)
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg1 = _make_message(text="@rkartside_bot cotización para Manuel", entities=[entity], message_id=100)
-    msg1.chat = MagicMock(id=1)
+    msg1.chat = SimpleNamespace(id=1)
     msg1.reply_to_message = None
 
-    claude = MagicMock()
+    claude = _mock_claude()
     claude.send_message.return_value = ClaudeResponse(
         text="Generando cotización...", file_ids=[],
         container_id="c1", raw_content=["mock"],
     )
 
-    async def mock_send_status(token, chat_id, reply_to, text):
+    async def mock_send_status(http, token, chat_id, reply_to, text):
         return 900
 
-    async def mock_delete_message(token, chat_id, message_id):
+    async def mock_delete_message(http, token, chat_id, message_id):
         pass
 
-    async def mock_send_text(token, chat_id, reply_to, text):
+    async def mock_send_text(http, token, chat_id, reply_to, text):
         return 201  # bot's reply message_id
 
     async def mock_send_document(http, token, chat_id, reply_to, filename, content):
@@ -334,23 +456,25 @@ async def test_handle_message_reply_continues_conversation():
          patch("bot._send_text", mock_send_text), \
          patch("bot._send_document", mock_send_document):
         await handle_message(
-            message=msg1, bot_user_id=123, bot_username="rkartside_bot",
+            message=msg1, bot_user_id=123, bot_mention="@rkartside_bot",
             claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
         )
 
     # Verify first conversation has 2 messages (user + assistant)
-    conv = store.get_or_create(chat_id=1, root_message_id=100)
+    conv = await store.get_or_create(chat_id=1, root_message_id=100)
     assert len(conv.messages) == 2
 
     # Step 2: User replies to bot's text message (msg 201) with "quita los itbis"
-    bot_reply = MagicMock()
-    bot_reply.message_id = 201
-    bot_reply.from_user = MagicMock(id=123)  # bot's user id
-    bot_reply.reply_to_message = None  # Telegram truncates nesting
-    bot_reply.voice = None
+    bot_reply = SimpleNamespace(
+        message_id=201,
+        from_user=SimpleNamespace(id=123),  # bot's user id
+        reply_to_message=None,  # Telegram truncates nesting
+        voice=None,
+    )
 
     msg2 = _make_message(text="quita los itbis", message_id=300)
-    msg2.chat = MagicMock(id=1)
+    msg2.chat = SimpleNamespace(id=1)
     msg2.reply_to_message = bot_reply
     msg2.entities = []
 
@@ -364,42 +488,44 @@ async def test_handle_message_reply_continues_conversation():
          patch("bot._send_text", mock_send_text), \
          patch("bot._send_document", mock_send_document):
         await handle_message(
-            message=msg2, bot_user_id=123, bot_username="rkartside_bot",
+            message=msg2, bot_user_id=123, bot_mention="@rkartside_bot",
             claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
         )
 
     # Should have 4 messages now (2 from first turn + 2 from second turn)
+    conv = await store.get_or_create(chat_id=1, root_message_id=100)
     assert len(conv.messages) == 4
     assert conv.messages[2]["content"] == "quita los itbis"
 
 
-@pytest.mark.asyncio
 async def test_handle_message_mention_reply_to_non_bot_includes_original_text():
     """Tagging bot in reply to a non-bot message should include the original text."""
     store = _mock_store()
 
     # The original message (not from the bot)
-    original = MagicMock()
-    original.message_id = 50
-    original.from_user = MagicMock(id=999)  # not the bot
-    original.reply_to_message = None
-    original.text = "Cotización para Juan, 3 sillas a $5,000 cada una"
-    original.voice = None
+    original = SimpleNamespace(
+        message_id=50,
+        from_user=SimpleNamespace(id=999),  # not the bot
+        reply_to_message=None,
+        text="Cotización para Juan, 3 sillas a $5,000 cada una",
+        voice=None,
+    )
 
     # User replies to their own message tagging the bot
     entity = _make_entity("mention", offset=0, length=14, user=None)
     msg = _make_message(text="@rkartside_bot hazme esto", entities=[entity], message_id=60)
-    msg.chat = MagicMock(id=1)
+    msg.chat = SimpleNamespace(id=1)
     msg.reply_to_message = original
 
-    claude = MagicMock()
+    claude = _mock_claude()
     claude.send_message.return_value = ClaudeResponse(
         text="Generando...", file_ids=[], container_id="c1", raw_content=["mock"],
     )
 
     sent_texts = []
 
-    async def mock_send_text(token, chat_id, reply_to, text):
+    async def mock_send_text(http, token, chat_id, reply_to, text):
         sent_texts.append(text)
         return 700
 
@@ -408,8 +534,9 @@ async def test_handle_message_mention_reply_to_non_bot_includes_original_text():
          patch("bot._send_text", mock_send_text), \
          patch("bot._send_document", AsyncMock(return_value=None)):
         await handle_message(
-            message=msg, bot_user_id=123, bot_username="rkartside_bot",
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
             claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
         )
 
     # Claude should have been called with text that includes the original message
@@ -419,3 +546,201 @@ async def test_handle_message_mention_reply_to_non_bot_includes_original_text():
     assert "[Mensaje original]:" in user_msg
     assert "Cotización para Juan" in user_msg
     assert "hazme esto" in user_msg
+
+
+async def test_handle_message_file_failure_still_registers_text():
+    """A failed document download should not prevent the text reply from being registered."""
+    entity = _make_entity("mention", offset=0, length=14, user=None)
+    msg = _make_message(text="@rkartside_bot cotización", entities=[entity], message_id=10)
+    msg.chat = SimpleNamespace(id=1)
+    msg.reply_to_message = None
+
+    claude = _mock_claude()
+    claude.send_message.return_value = ClaudeResponse(
+        text="Tu cotización:", file_ids=["file_1", "file_2"],
+        container_id="c1", raw_content=[],
+    )
+    claude.download_file.side_effect = [RuntimeError("download failed"), ("b.pdf", io.BytesIO(b"pdf"))]
+
+    store = _mock_store()
+
+    async def mock_send_text(http, token, chat_id, reply_to, text):
+        return 500
+
+    async def mock_send_document(http, token, chat_id, reply_to, filename, content):
+        return 502
+
+    with patch("bot._send_text", mock_send_text), \
+         patch("bot._send_document", mock_send_document):
+        await handle_message(
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
+            claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
+        )
+
+    assert await store.find_root(1, 500) == 10
+    assert await store.find_root(1, 502) == 10
+
+
+async def test_handle_message_saves_turn_and_text_before_documents_are_sent():
+    """A reply to the text works while documents upload; the turn is saved first."""
+    entity = _make_entity("mention", offset=0, length=14, user=None)
+    msg = _make_message(text="@rkartside_bot cotización", entities=[entity], message_id=10)
+    msg.chat = SimpleNamespace(id=1)
+    msg.reply_to_message = None
+
+    claude = _mock_claude()
+    claude.send_message.return_value = ClaudeResponse(
+        text="Tu cotización:", file_ids=["file_1"], container_id="c1", raw_content=[],
+    )
+    claude.download_file.return_value = ("a.pdf", io.BytesIO(b"pdf"))
+    store = _mock_store()
+    text_sent = asyncio.Event()
+    seen_during_upload = {}
+
+    async def mock_send_text(http, token, chat_id, reply_to, text):
+        text_sent.set()
+        return 500
+
+    async def mock_send_document(http, token, chat_id, reply_to, filename, content):
+        await text_sent.wait()
+        await asyncio.sleep(0)  # let the text registration land
+        seen_during_upload["root"] = await store.find_root(1, 500)
+        seen_during_upload["history"] = len(store._convs[(1, 10)].messages)
+        raise httpx.ReadTimeout("upload failed")
+
+    with patch("bot._send_text", mock_send_text), \
+         patch("bot._send_document", mock_send_document):
+        await handle_message(
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
+            claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
+        )
+
+    assert seen_during_upload == {"root": 10, "history": 2}
+
+
+async def test_handle_message_sends_multiple_files_as_media_group():
+    """Several files go out in one sendMediaGroup call and every message is registered."""
+    entity = _make_entity("mention", offset=0, length=14, user=None)
+    msg = _make_message(text="@rkartside_bot cotización", entities=[entity], message_id=10)
+    msg.chat = SimpleNamespace(id=1)
+    msg.reply_to_message = None
+
+    claude = _mock_claude()
+    claude.send_message.return_value = ClaudeResponse(
+        text="", file_ids=["file_1", "file_2"], container_id="c1", raw_content=[],
+    )
+    claude.download_file.side_effect = lambda file_id: (f"{file_id}.pdf", io.BytesIO(b"pdf"))
+
+    store = _mock_store()
+    groups = []
+
+    async def mock_send_media_group(http, token, chat_id, reply_to, documents):
+        groups.append(sorted(name for name, _ in documents))
+        return [601, 602]
+
+    with patch("bot._send_media_group", mock_send_media_group), \
+         patch("bot._send_document", AsyncMock()) as mock_send_document:
+        await handle_message(
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
+            claude=claude, store=store, transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
+        )
+
+    assert groups == [["file_1.pdf", "file_2.pdf"]]
+    mock_send_document.assert_not_called()
+    assert await store.find_root(1, 601) == 10
+    assert await store.find_root(1, 602) == 10
+
+
+async def test_send_documents_falls_back_to_single_sends_when_album_fails():
+    """A failed album is resent file by file; earlier batches keep their ids."""
+    claude = _mock_claude()
+    file_ids = [f"file_{i}" for i in range(bot.MEDIA_GROUP_MAX + 2)]
+    claude.download_file.side_effect = lambda file_id: (f"{file_id}.pdf", io.BytesIO(b"pdf"))
+    sent = iter(range(700, 800))
+
+    async def mock_send_media_group(http, token, chat_id, reply_to, documents):
+        if len(documents) == bot.MEDIA_GROUP_MAX:
+            return [next(sent) for _ in documents]
+        raise httpx.ConnectError("unreachable")
+
+    async def mock_send_document(http, token, chat_id, reply_to, filename, content):
+        if filename == f"file_{bot.MEDIA_GROUP_MAX}.pdf":
+            raise httpx.ReadTimeout("too big")
+        return 900
+
+    with patch("bot._send_media_group", mock_send_media_group), \
+         patch("bot._send_document", mock_send_document):
+        register = AsyncMock()
+        ids = await bot._send_documents(AsyncMock(), claude, "tok", 1, 10, file_ids, register)
+
+    assert ids == list(range(700, 700 + bot.MEDIA_GROUP_MAX)) + [900]
+    assert [c.args[0] for c in register.await_args_list] == [list(range(700, 700 + bot.MEDIA_GROUP_MAX)), [900]]
+
+
+async def test_voice_reminder_sent_once_until_expired(monkeypatch):
+    """Unsolicited voice notes get a single reminder per chat until it expires."""
+    msg = _make_message(message_id=70)
+    msg.chat = SimpleNamespace(id=4242)
+    msg.voice = MagicMock(file_id="voice_1")
+
+    sent = []
+
+    async def mock_send_text(http, token, chat_id, reply_to, text):
+        sent.append(text)
+        return 800
+
+    async def send_voice():
+        await handle_message(
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
+            claude=MagicMock(), store=_mock_store(), transcriber=MagicMock(), telegram_token="tok",
+            http=AsyncMock(),
+        )
+
+    with patch("bot._send_text", mock_send_text):
+        await send_voice()
+        await send_voice()
+        assert len(sent) == 1
+
+        monkeypatch.setattr("bot.VOICE_REMINDER_TTL", 0)
+        await send_voice()
+        assert len(sent) == 2
+
+
+async def test_voice_transcription_failure_deletes_status_in_background():
+    bot_reply = SimpleNamespace(message_id=201, from_user=SimpleNamespace(id=123), voice=None)
+    msg = _make_message(reply_to=bot_reply, message_id=71)
+    msg.chat = SimpleNamespace(id=1)
+    msg.voice = MagicMock(file_id="voice_1")
+
+    transcriber = MagicMock()
+    transcriber.transcribe_voice = AsyncMock(side_effect=RuntimeError("soniox down"))
+
+    calls = []
+
+    async def mock_send_status(http, token, chat_id, reply_to, text):
+        return 888
+
+    async def mock_delete_message(http, token, chat_id, message_id):
+        calls.append(("delete", message_id))
+
+    async def mock_send_text(http, token, chat_id, reply_to, text):
+        calls.append(("text", text))
+        return 501
+
+    with patch("bot._send_status", mock_send_status), \
+         patch("bot._delete_message", mock_delete_message), \
+         patch("bot._send_text", mock_send_text):
+        await handle_message(
+            message=msg, bot_user_id=123, bot_mention="@rkartside_bot",
+            claude=_mock_claude(), store=_mock_store(), transcriber=transcriber, telegram_token="tok",
+            http=AsyncMock(),
+        )
+        await asyncio.gather(*bot._background)
+
+    assert calls == [
+        ("text", "No pude transcribir el audio. Intenta de nuevo."),
+        ("delete", 888),
+    ]
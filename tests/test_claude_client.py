@@ -1,6 +1,27 @@
+from collections import namedtuple
+
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
-from claude_client import ClaudeClient, ClaudeResponse
+from anthropic.types.beta import BetaTextBlock
+from claude_client import SYSTEM_BLOCK, ClaudeClient, ClaudeResponse
+
+
+def _block(name, fields):
+    cls = namedtuple(name, fields)
+    cls.model_dump = cls._asdict  # extract_response dumps every block for history
+    return cls
+
+
+# Plain stand-ins for SDK content blocks; extract_response only reads these fields
+Block = _block("Block", ["type", "text"])
+FileBlock = _block("FileBlock", ["type", "file_id"])
+ExecResult = _block("ExecResult", ["type", "content"])
+ToolResult = _block("ToolResult", ["type", "content"])
+
+
+def _code_execution(file_id):
+    return ToolResult("bash_code_execution_tool_result",
+                      ExecResult("bash_code_execution_result", [FileBlock("file", file_id)]))
 
 
 @pytest.fixture
@@ -12,8 +33,8 @@ def test_extract_text_from_response(client):
     """Test extracting text blocks from a Claude API response (no code execution)."""
     response = MagicMock()
     response.content = [
-        MagicMock(type="text", text="Here is your document"),
-        MagicMock(type="text", text=" - total RD$ 12,435"),
+        Block("text", "Here is your document"),
+        Block("text", " - total RD$ 12,435"),
     ]
     response.stop_reason = "end_turn"
     response.container = MagicMock(id="container_123")
@@ -26,24 +47,8 @@ def test_extract_text_from_response(client):
 
 def test_extract_file_ids_from_response(client):
     """Test extracting file_ids from code execution results."""
-    file_block = MagicMock()
-    file_block.file_id = "file_abc"
-    file_block.type = "file"
-
-    exec_result = MagicMock()
-    exec_result.type = "bash_code_execution_result"
-    exec_result.content = [file_block]
-
-    tool_result = MagicMock()
-    tool_result.type = "bash_code_execution_tool_result"
-    tool_result.content = exec_result
-
-    text_block = MagicMock()
-    text_block.type = "text"
-    text_block.text = "PDF generated"
-
     response = MagicMock()
-    response.content = [tool_result, text_block]
+    response.content = [_code_execution("file_abc"), Block("text", "PDF generated")]
     response.stop_reason = "end_turn"
     response.container = MagicMock(id="container_456")
 
@@ -54,24 +59,12 @@ def test_extract_file_ids_from_response(client):
 
 def test_extract_response_filters_text_before_code_execution(client):
     """Text before code execution blocks should be filtered out (verbose narration)."""
-    file_block = MagicMock()
-    file_block.file_id = "file_abc"
-    file_block.type = "file"
-
-    exec_result = MagicMock()
-    exec_result.type = "bash_code_execution_result"
-    exec_result.content = [file_block]
-
-    tool_result = MagicMock()
-    tool_result.type = "bash_code_execution_tool_result"
-    tool_result.content = exec_result
-
     response = MagicMock()
     response.content = [
-        MagicMock(type="text", text="Voy a generar el documento con los siguientes datos..."),
-        MagicMock(type="text", text="Calculando totales e ITBIS..."),
-        tool_result,
-        MagicMock(type="text", text="Aquí está tu cotización."),
+        Block("text", "Voy a generar el documento con los siguientes datos..."),
+        Block("text", "Calculando totales e ITBIS..."),
+        _code_execution("file_abc"),
+        Block("text", "Aquí está tu cotización."),
     ]
     response.stop_reason = "end_turn"
     response.container = MagicMock(id="container_789")
@@ -85,8 +78,8 @@ def test_extract_response_keeps_all_text_when_no_code_execution(client):
     """When no code execution happens, all text blocks are kept."""
     response = MagicMock()
     response.content = [
-        MagicMock(type="text", text="Necesito saber "),
-        MagicMock(type="text", text="si incluye ITBIS."),
+        Block("text", "Necesito saber "),
+        Block("text", "si incluye ITBIS."),
     ]
     response.stop_reason = "end_turn"
     response.container = MagicMock(id="container_abc")
@@ -96,6 +89,15 @@ def test_extract_response_keeps_all_text_when_no_code_execution(client):
     assert result.file_ids == []
 
 
+def test_extract_response_keeps_history_as_plain_dicts(client):
+    response = MagicMock()
+    response.content = [BetaTextBlock(type="text", text="Listo", citations=None)]
+    response.container = None
+
+    result = client.extract_response(response)
+    assert result.raw_content == [{"type": "text", "text": "Listo", "citations": None}]
+
+
 def test_needs_continuation(client):
     response = MagicMock()
     response.stop_reason = "pause_turn"
@@ -103,3 +105,35 @@ def test_needs_continuation(client):
 
     response.stop_reason = "end_turn"
     assert client.needs_continuation(response) is False
+
+
+async def test_download_file_streams_into_readable_file(client, monkeypatch):
+    async def chunks():
+        yield b"%PDF"
+        yield b"-1.4"
+
+    monkeypatch.setattr(client, "_client", MagicMock())
+    client._client.beta.files.retrieve_metadata = AsyncMock(return_value=MagicMock(filename="cot.pdf"))
+    stream = client._client.beta.files.with_streaming_response.download.return_value
+    stream.__aenter__.return_value.iter_bytes = MagicMock(return_value=chunks())
+
+    filename, content = await client.download_file("file_abc")
+
+    assert filename == "cot.pdf"
+    assert content.read() == b"%PDF-1.4"
+    content.close()
+
+
+async def test_send_message_keeps_static_system_block_separate(client, monkeypatch):
+    monkeypatch.setattr(client, "_client", MagicMock())
+    response = MagicMock()
+    response.content = [Block("text", "Listo")]
+    response.stop_reason = "end_turn"
+    response.container = MagicMock(id="container_1")
+    client._client.beta.messages.create = AsyncMock(return_value=response)
+
+    await client.send_message([{"role": "user", "content": "hola"}], system_extra="COT-2026-001")
+
+    system = client._client.beta.messages.create.call_args.kwargs["system"]
+    assert system[0] is SYSTEM_BLOCK
+    assert system[1] == {"type": "text", "text": "COT-2026-001"}
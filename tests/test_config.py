@@ -3,6 +3,13 @@ import pytest
 from config import load_config
 
 
+@pytest.fixture(autouse=True)
+def fresh_config():
+    load_config.cache_clear()
+    yield
+    load_config.cache_clear()
+
+
 def test_load_config_from_env(monkeypatch):
     monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "test-token")
     monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
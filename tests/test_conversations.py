@@ -1,7 +1,9 @@
 import os
-import time
 import pytest
-from conversations import ConversationStore
+import pytest_asyncio
+from psycopg_pool import PoolTimeout
+import conversations
+from conversations import SCHEMA_VERSION, ConversationStore
 
 TEST_DB_URL = os.environ.get(
     "TEST_DATABASE_URL",
@@ -9,113 +11,185 @@ TEST_DB_URL = os.environ.get(
 )
 
 
-def _exec(store, sql, params=None):
-    with store._pool.connection() as conn:
-        return conn.execute(sql, params).fetchone()
+async def _exec(store, sql, params=None):
+    async with store._pool.connection() as conn:
+        return await (await conn.execute(sql, params)).fetchone()
 
 
-@pytest.fixture
-def store():
+async def _register(store, chat_id, root_message_id, *message_ids):
+    """Map several messages to a root with one multi-row INSERT."""
+    async with store._pool.connection() as conn:
+        await conn.execute(
+            "INSERT INTO message_registry (chat_id, message_id, root_message_id)"
+            " SELECT %s, unnest(%s::bigint[]), %s",
+            (chat_id, list(message_ids), root_message_id),
+        )
+
+
+# One store (and pool) for the module; tests share the session event loop
+@pytest_asyncio.fixture(scope="module")
+async def store():
     s = ConversationStore(database_url=TEST_DB_URL, ttl_seconds=86400)
-    with s._pool.connection() as conn:
-        conn.execute("DELETE FROM message_registry")
-        conn.execute("DELETE FROM conversations")
+    try:
+        await s._pool.open(wait=True, timeout=5)
+    except PoolTimeout:
+        await s.close()
+        pytest.skip(f"Postgres not reachable at {TEST_DB_URL}")
+    await s.open()
     yield s
-    s._pool.close()
+    await s.close()
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clean_store(store):
+    async with store._pool.connection() as conn:
+        await conn.execute("TRUNCATE message_registry, conversations")
 
 
-def test_new_mention_creates_conversation(store):
-    conv = store.get_or_create(chat_id=1, root_message_id=100)
+@pytest_asyncio.fixture
+async def expired_conversation(store):
+    """Conversation (1, 100) idle past the TTL, with messages 100 and 101 mapped to it."""
+    async with store._pool.connection() as conn:
+        await conn.execute("""
+            WITH conv AS (
+                INSERT INTO conversations (chat_id, root_message_id, messages, last_activity)
+                VALUES (1, 100, '[{"role": "user", "content": "test"}]', NOW() - interval '2 days')
+            )
+            INSERT INTO message_registry (chat_id, message_id, root_message_id)
+            VALUES (1, 100, 100), (1, 101, 100)
+        """)
+
+
+async def test_new_mention_creates_conversation(store):
+    conv = await store.get_or_create(chat_id=1, root_message_id=100)
     assert conv.messages == []
     assert conv.container_id is None
 
 
-def test_same_key_returns_same_conversation(store):
-    conv1 = store.get_or_create(chat_id=1, root_message_id=100)
+async def test_same_key_returns_same_conversation(store):
+    conv1 = await store.get_or_create(chat_id=1, root_message_id=100)
     conv1.messages.append({"role": "user", "content": "hello"})
-    store.save(1, 100, conv1)
+    await store.save(1, 100, conv1)
 
-    conv2 = store.get_or_create(chat_id=1, root_message_id=100)
+    conv2 = await store.get_or_create(chat_id=1, root_message_id=100)
     assert conv2.messages == [{"role": "user", "content": "hello"}]
 
 
-def test_different_root_message_creates_separate_conversation(store):
-    conv1 = store.get_or_create(chat_id=1, root_message_id=100)
+async def test_different_root_message_creates_separate_conversation(store):
+    conv1 = await store.get_or_create(chat_id=1, root_message_id=100)
     conv1.messages.append({"role": "user", "content": "hello"})
-    store.save(1, 100, conv1)
+    await store.save(1, 100, conv1)
 
-    conv2 = store.get_or_create(chat_id=1, root_message_id=200)
+    conv2 = await store.get_or_create(chat_id=1, root_message_id=200)
     assert conv2.messages == []
 
 
-def test_cleanup_removes_expired_conversations(store):
-    store._ttl = 1
-    conv = store.get_or_create(chat_id=1, root_message_id=100)
-    conv.messages.append({"role": "user", "content": "test"})
-    store.save(1, 100, conv)
-    _exec(store,
-        "UPDATE conversations SET last_activity = NOW() - interval '2 seconds' WHERE chat_id = 1 AND root_message_id = 100"
-    )
-
-    store.cleanup()
-    conv2 = store.get_or_create(chat_id=1, root_message_id=100)
-    assert conv2.messages == []
+async def test_cleanup_removes_expired_conversations(store, expired_conversation):
+    await store.cleanup()
+    conv = await store.get_or_create(chat_id=1, root_message_id=100)
+    assert conv.messages == []
 
 
-def test_get_or_create_updates_last_activity(store):
-    store.get_or_create(chat_id=1, root_message_id=100)
-    row1 = _exec(store,
-        "SELECT last_activity FROM conversations WHERE chat_id = 1 AND root_message_id = 100"
+async def test_get_or_create_updates_last_activity(store):
+    await store.get_or_create(chat_id=1, root_message_id=100)
+    row1 = await _exec(store,
+        "UPDATE conversations SET last_activity = last_activity - interval '1 second'"
+        " WHERE chat_id = 1 AND root_message_id = 100 RETURNING last_activity"
     )
 
-    time.sleep(0.01)
-    store.get_or_create(chat_id=1, root_message_id=100)
-    row2 = _exec(store,
+    await store.get_or_create(chat_id=1, root_message_id=100)
+    row2 = await _exec(store,
         "SELECT last_activity FROM conversations WHERE chat_id = 1 AND root_message_id = 100"
     )
-    assert row2[0] >= row1[0]
+    assert row2[0] > row1[0]
 
 
 # --- register_message / find_root ---
 
-def test_register_and_find_root(store):
-    store.register_message(chat_id=1, message_id=101, root_message_id=100)
-    assert store.find_root(chat_id=1, message_id=101) == 100
+async def test_register_and_find_root(store):
+    await store.register_message(chat_id=1, message_id=101, root_message_id=100)
+    assert await store.find_root(chat_id=1, message_id=101) == 100
 
 
-def test_find_root_returns_none_for_unknown(store):
-    assert store.find_root(chat_id=1, message_id=999) is None
+async def test_find_root_returns_none_for_unknown(store):
+    assert await store.find_root(chat_id=1, message_id=999) is None
 
 
-def test_find_root_isolates_by_chat(store):
-    store.register_message(chat_id=1, message_id=101, root_message_id=100)
-    assert store.find_root(chat_id=2, message_id=101) is None
+async def test_find_root_isolates_by_chat(store):
+    await store.register_message(chat_id=1, message_id=101, root_message_id=100)
+    assert await store.find_root(chat_id=2, message_id=101) is None
 
 
-def test_cleanup_removes_message_mappings(store):
-    store._ttl = 1
-    store.get_or_create(chat_id=1, root_message_id=100)
-    store.register_message(chat_id=1, message_id=100, root_message_id=100)
-    store.register_message(chat_id=1, message_id=101, root_message_id=100)
-    _exec(store,
-        "UPDATE conversations SET last_activity = NOW() - interval '2 seconds' WHERE chat_id = 1 AND root_message_id = 100"
-    )
+async def test_cleanup_removes_message_mappings(store, expired_conversation):
+    await store.cleanup()
+    assert await store.find_root(chat_id=1, message_id=100) is None
+    assert await store.find_root(chat_id=1, message_id=101) is None
+
+
+async def test_cleanup_deletes_in_batches(store, expired_conversation, monkeypatch):
+    await _exec(store, """
+        WITH conv AS (
+            INSERT INTO conversations (chat_id, root_message_id, last_activity)
+            VALUES (1, 200, NOW() - interval '2 days')
+        )
+        INSERT INTO message_registry (chat_id, message_id, root_message_id)
+        VALUES (1, 200, 200) RETURNING 1
+    """)
+    monkeypatch.setattr(conversations, "CLEANUP_BATCH_SIZE", 1)
+
+    await store.cleanup()
+    assert await store.registry_size() == 0
+
+
+async def test_cleanup_preserves_active_message_mappings(store):
+    await store.get_or_create(chat_id=1, root_message_id=100)
+    await store.register_message(chat_id=1, message_id=101, root_message_id=100)
+
+    await store.cleanup()
+    assert await store.find_root(chat_id=1, message_id=101) == 100
+
+
+async def test_registry_size(store):
+    assert await store.registry_size() == 0
+    await _register(store, 1, 100, *range(101, 151))
+    assert await store.registry_size() == 50
+
+
+async def test_commit_turn_appends_turn_and_registers_messages(store):
+    await store.get_or_create(chat_id=1, root_message_id=100)
+    first = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi"}]
+    second = [{"role": "user", "content": "again"}, {"role": "assistant", "content": "sure"}]
+
+    await store.commit_turn(1, 100, first, "c1")
+    await store.register_messages(1, 100, [100, 201])
+    await store.commit_turn(1, 100, second, "c2")
+    await store.register_messages(1, 100, [202])
+
+    saved = await store.get_or_create(chat_id=1, root_message_id=100)
+    assert saved.messages == first + second
+    assert saved.container_id == "c2"
+    assert [await store.find_root(chat_id=1, message_id=m) for m in (100, 201, 202)] == [100, 100, 100]
+
+
+async def test_begin_turn_resolves_root_and_registers_message(store):
+    root_id, conv, found = await store.begin_turn(chat_id=1, message_id=100, replied_to_id=None)
+    assert (root_id, conv.messages, found) == (100, [], False)
 
-    store.cleanup()
-    assert store.find_root(chat_id=1, message_id=100) is None
-    assert store.find_root(chat_id=1, message_id=101) is None
+    await store.register_message(chat_id=1, message_id=201, root_message_id=100)
+    root_id, _, found = await store.begin_turn(chat_id=1, message_id=300, replied_to_id=201)
+    assert (root_id, found) == (100, True)
+    assert await store.find_root(chat_id=1, message_id=300) == 100
 
 
-def test_cleanup_preserves_active_message_mappings(store):
-    store.get_or_create(chat_id=1, root_message_id=100)
-    store.register_message(chat_id=1, message_id=101, root_message_id=100)
+async def test_begin_turn_falls_back_to_replied_message(store):
+    root_id, _, found = await store.begin_turn(chat_id=1, message_id=300, replied_to_id=250)
+    assert (root_id, found) == (250, False)
+    assert await store.find_root(chat_id=1, message_id=300) == 250
 
-    store.cleanup()
-    assert store.find_root(chat_id=1, message_id=101) == 100
 
+async def test_open_records_schema_version(store):
+    row = await _exec(store, "SELECT MAX(version) FROM schema_version")
+    assert row[0] == SCHEMA_VERSION
 
-def test_registry_size(store):
-    assert store.registry_size() == 0
-    store.register_message(chat_id=1, message_id=101, root_message_id=100)
-    store.register_message(chat_id=1, message_id=102, root_message_id=100)
-    assert store.registry_size() == 2
+    await store.open()  # already migrated: no DDL, still usable
+    assert await store.find_root(chat_id=1, message_id=999) is None
@@ -0,0 +1,27 @@
+import pytest_asyncio
+from unittest.mock import AsyncMock
+from transcriber import Transcriber
+
+
+@pytest_asyncio.fixture
+async def transcriber(monkeypatch):
+    t = Transcriber(soniox_api_key="test-key")
+    monkeypatch.setattr(t, "_transcribe", AsyncMock(return_value="hola mundo"))
+    yield t
+    await t.aclose()
+
+
+async def test_transcript_reused_for_same_file_unique_id(transcriber):
+    first = await transcriber.transcribe_voice("tok", "file_1", "uniq_1")
+    second = await transcriber.transcribe_voice("tok", "file_2", "uniq_1")
+
+    assert first == second == "hola mundo"
+    transcriber._transcribe.assert_awaited_once_with("tok", "file_1")
+
+
+async def test_empty_transcript_not_cached(transcriber):
+    transcriber._transcribe.return_value = None
+    await transcriber.transcribe_voice("tok", "file_1", "uniq_1")
+    await transcriber.transcribe_voice("tok", "file_1", "uniq_1")
+
+    assert transcriber._transcribe.await_count == 2
@@ -1,37 +1,115 @@
+import asyncio
 import logging
+import tempfile
+import time
+from collections import OrderedDict
+
 import httpx
-from soniox import SonioxClient
+from soniox import AsyncSonioxClient
 from soniox.types import CreateTranscriptionConfig
 from soniox.utils import render_tokens
 
+from telegram_api import api_url
+
 logger = logging.getLogger(__name__)
 
+VOICE_SPOOL_MAX_BYTES = 1024 * 1024  # voice notes above this spill to disk
+
+# Short voice notes finish in well under the SDK's fixed 5s poll interval;
+# start polling fast and back off for longer clips.
+POLL_INITIAL_DELAY = 0.2  # seconds
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF = 1.5
+POLL_TIMEOUT = 120.0
+
+# Forwarded or re-mentioned voice notes share Telegram's file_unique_id, so
+# their transcript is reused instead of paying for another Soniox run.
+TRANSCRIPT_CACHE_TTL = 24 * 3600  # seconds
+TRANSCRIPT_CACHE_MAX = 256
+
 
 class Transcriber:
     def __init__(self, soniox_api_key: str):
-        self._client = SonioxClient(api_key=soniox_api_key)
+        # Async SDK client so a voice note doesn't park a worker thread for the
+        # whole getFile/download/upload/poll sequence.
+        self._client = AsyncSonioxClient(api_key=soniox_api_key)
+        # Kept for the process lifetime so getFile and the download reuse a
+        # keep-alive connection to api.telegram.org instead of a new handshake.
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+        )
+        # file_unique_id -> (expires_at, transcript)
+        self._transcripts: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def aclose(self):
+        await self._http.aclose()
+        await self._client.aclose()
 
-    def transcribe_voice(self, telegram_token: str, file_id: str) -> str | None:
+    async def _wait_for(self, transcription_id: str):
+        """Poll until the transcription leaves the queued/processing states."""
+        delay = POLL_INITIAL_DELAY
+        async with asyncio.timeout(POLL_TIMEOUT):
+            while True:
+                transcription = await self._client.transcriptions.get(transcription_id)
+                if transcription.status not in ("queued", "processing"):
+                    return transcription
+                await asyncio.sleep(delay)
+                delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+
+    def _cached_transcript(self, key: str) -> str | None:
+        entry = self._transcripts.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._transcripts[key]
+            return None
+        self._transcripts.move_to_end(key)
+        return entry[1]
+
+    def _cache_transcript(self, key: str, text: str):
+        self._transcripts[key] = (time.monotonic() + TRANSCRIPT_CACHE_TTL, text)
+        self._transcripts.move_to_end(key)
+        while len(self._transcripts) > TRANSCRIPT_CACHE_MAX:
+            self._transcripts.popitem(last=False)
+
+    async def transcribe_voice(self, telegram_token: str, file_id: str,
+                               file_unique_id: str | None = None) -> str | None:
+        """Transcribe a Telegram voice file, reusing the transcript of a file
+        already seen under the same file_unique_id."""
+        if file_unique_id:
+            cached = self._cached_transcript(file_unique_id)
+            if cached is not None:
+                logger.info("Transcript cache hit: %s", file_unique_id)
+                return cached
+        text = await self._transcribe(telegram_token, file_id)
+        if text and file_unique_id:
+            self._cache_transcript(file_unique_id, text)
+        return text
+
+    async def _transcribe(self, telegram_token: str, file_id: str) -> str | None:
         """Download a Telegram voice file and transcribe it via Soniox."""
         # Get file path from Telegram
-        with httpx.Client() as http:
-            resp = http.get(f"https://api.telegram.org/bot{telegram_token}/getFile",
-                            params={"file_id": file_id})
-            file_path = resp.json()["result"]["file_path"]
-
-            # Download the voice file
-            resp = http.get(f"https://api.telegram.org/file/bot{telegram_token}/{file_path}")
-            audio_bytes = resp.content
+        resp = await self._http.get(api_url(telegram_token, "getFile"), params={"file_id": file_id})
+        file_path = resp.json()["result"]["file_path"]
 
-        logger.info("Downloaded voice file: %s (%d bytes)", file_path, len(audio_bytes))
+        # Stream the voice file into a spooled temp file instead of holding the whole body
+        with tempfile.SpooledTemporaryFile(max_size=VOICE_SPOOL_MAX_BYTES) as audio:
+            async with self._http.stream(
+                "GET", f"https://api.telegram.org/file/bot{telegram_token}/{file_path}"
+            ) as resp:
+                async for chunk in resp.aiter_bytes(65536):
+                    audio.write(chunk)
+            logger.info("Downloaded voice file: %s (%d bytes)", file_path, audio.tell())
+            audio.seek(0)
 
-        # Upload to Soniox
-        uploaded = self._client.files.upload(audio_bytes)
+            # Upload to Soniox
+            uploaded = await self._client.files.upload(audio, filename=file_path.rsplit("/", 1)[-1])
         logger.info("Uploaded to Soniox: file_id=%s", uploaded.id)
 
         try:
             # Create transcription
-            transcription = self._client.transcriptions.create(
+            transcription = await self._client.transcriptions.create(
                 config=CreateTranscriptionConfig(
                     model="stt-async-v4",
                     language_hints=["es", "en"],
@@ -40,16 +118,18 @@ class Transcriber:
             )
 
             # Wait for completion
-            self._client.transcriptions.wait(transcription.id)
+            transcription = await self._wait_for(transcription.id)
+            if transcription.status == "error":
+                raise RuntimeError(f"Soniox transcription failed: {transcription.error_message}")
 
             # Get result
-            result = self._client.transcriptions.get_transcript(transcription.id)
+            result = await self._client.transcriptions.get_transcript(transcription.id)
             text = render_tokens(result.tokens, []).strip()
             logger.info("Transcription complete: %r", text[:120])
 
             # Cleanup
-            self._client.transcriptions.delete(transcription.id)
+            await self._client.transcriptions.delete(transcription.id)
 
             return text if text else None
         finally:
-            self._client.files.delete(uploaded.id)
+            await self._client.files.delete(uploaded.id)